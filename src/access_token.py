@@ -1,4 +1,4 @@
-import requests
+from src import http_client
 import base64
 import json
 from pathlib import Path
@@ -72,7 +72,7 @@ def get_headers():
 
 
 def get_access_token():
-    response = requests.request(method="POST", url=TOKEN_URL, data=get_payload(), headers=get_headers())
+    response = http_client.request(method="POST", url=TOKEN_URL, data=get_payload(), headers=get_headers())
     if response.status_code == 200:
         access_token_path = Path(data_dir / "access_token.json")
         access_token_path.touch(exist_ok=True)
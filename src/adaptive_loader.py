@@ -0,0 +1,162 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from src import resilience
+from src.http_client import POOL_MAXSIZE
+
+# Concurrent loader for resources that have to be POSTed one at a time. The number of requests in flight
+# follows AIMD (additive increase, multiplicative decrease) like TCP congestion control: it grows by about one
+# per round trip while responses are fast and successful, and is halved when the server answers 429/503 or
+# a 5xx error, the connection fails or latency stays well above its usual level for several responses in a
+# row. After a 429/503 nothing is sent until its Retry-After (or a jittered backoff) has passed.
+INITIAL_LIMIT = 4
+MIN_LIMIT = 1
+# More requests in flight than pooled connections would open and discard extra connections
+MAX_LIMIT = POOL_MAXSIZE
+BACKOFF_FACTOR = 0.5
+# A response slower than this multiple of the smoothed latency counts as a latency spike
+LATENCY_TOLERANCE = 3.0
+LATENCY_SMOOTHING = 0.1
+# Consecutive latency spikes that count as overload; a single slow response is only an outlier
+SUSTAINED_SPIKES = 3
+THROTTLE_STATUS_CODES = (429, 503)
+MAX_THROTTLE_RETRIES = 3
+
+_END = object()
+
+
+class AdaptiveLimit:
+    def __init__(self, initial_limit=INITIAL_LIMIT, min_limit=MIN_LIMIT, max_limit=MAX_LIMIT):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency = None
+        self.spikes = 0
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    def current(self):
+        with self.lock:
+            return max(self.min_limit, int(self.limit))
+
+    def on_success(self, latency):
+        """
+        Grows the limit by 1/limit per response (about +1 per window). The smoothed latency follows every
+        response; SUSTAINED_SPIKES responses in a row slower than LATENCY_TOLERANCE times it halve the limit.
+        """
+        with self.lock:
+            spike = self.latency is not None and latency > LATENCY_TOLERANCE * self.latency
+            self.latency = latency if self.latency is None else (
+                (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency)
+            if not spike:
+                self.spikes = 0
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                return
+            self.spikes += 1
+            if self.spikes >= SUSTAINED_SPIKES:
+                self.spikes = 0
+                self.decrease_locked()
+
+    def on_overload(self):
+        with self.lock:
+            self.decrease_locked()
+
+    def decrease_locked(self):
+        # Responses to requests sent before the last decrease reflect the old limit; back off once per round trip
+        now = time.monotonic()
+        if now - self.last_decrease < (self.latency or 0):
+            return
+        self.last_decrease = now
+        self.limit = max(self.min_limit, self.limit * BACKOFF_FACTOR)
+
+
+def is_overloaded(response):
+    return response is None or response.status_code in THROTTLE_STATUS_CODES
+
+
+def timed_send(send, item):
+    started = time.monotonic()
+    response = send(item)
+    return response, time.monotonic() - started
+
+
+def throttle_delay(response, attempt):
+    """
+    Seconds to wait before sending again after a 429/503: its Retry-After, else a jittered backoff.
+    """
+    retry_after = resilience.get_retry_after(response)
+    return retry_after if retry_after is not None else resilience.backoff_delay(attempt, resilience.DEFAULT_POLICY)
+
+
+def load_adaptively(items, send, initial_limit=INITIAL_LIMIT, max_limit=MAX_LIMIT):
+    """
+    Calls send(item) for every item on a thread pool. send returns the requests.Response, or None when the
+    request raised. send must not retry throttled requests itself (pass max_retries=0 to http_client), or
+    the 429/503 this loader reacts to never reaches it. At most the adaptive limit of requests is in
+    flight; items answered with 429/503 are sent again up to MAX_THROTTLE_RETRIES times, and no request
+    goes out until the Retry-After of the last throttled response has passed. Returns a dict with the
+    success/failure counts, the elapsed time, the achieved requests per second and the final limit.
+    """
+    limit = AdaptiveLimit(initial_limit, max_limit=max_limit)
+    items = iter(items)
+    exhausted = False
+    retries = deque()
+    resume_at = 0.0
+    stats = {"sent": 0, "succeeded": 0, "failed": 0, "throttled": 0}
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_limit) as executor:
+        in_flight = {}
+        while True:
+            while time.monotonic() >= resume_at and len(in_flight) < limit.current():
+                if retries:
+                    item, attempt = retries.popleft()
+                elif not exhausted:
+                    item = next(items, _END)
+                    if item is _END:
+                        exhausted = True
+                        break
+                    attempt = 0
+                else:
+                    break
+                in_flight[executor.submit(timed_send, send, item)] = (item, attempt)
+            if not in_flight:
+                if exhausted and not retries:
+                    break
+                time.sleep(max(0.0, resume_at - time.monotonic()))
+                continue
+            timeout = resume_at - time.monotonic()
+            done, _ = wait(in_flight, timeout=timeout if timeout > 0 else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                item, attempt = in_flight.pop(future)
+                stats["sent"] += 1
+                try:
+                    response, latency = future.result()
+                except Exception as e:
+                    print(f"Error during request: {e}")
+                    response, latency = None, None
+                if is_overloaded(response):
+                    limit.on_overload()
+                    if response is not None:
+                        stats["throttled"] += 1
+                        resume_at = max(resume_at, time.monotonic() + throttle_delay(response, attempt))
+                        if attempt < MAX_THROTTLE_RETRIES:
+                            retries.append((item, attempt + 1))
+                            continue
+                    stats["failed"] += 1
+                elif response.status_code >= 500:
+                    # Server errors are a failure signal: no growth, back off like an overload
+                    limit.on_overload()
+                    stats["failed"] += 1
+                elif response.status_code < 400:
+                    limit.on_success(latency)
+                    stats["succeeded"] += 1
+                else:
+                    limit.on_success(latency)
+                    stats["failed"] += 1
+    stats["elapsed"] = time.monotonic() - started
+    stats["requests_per_second"] = stats["sent"] / stats["elapsed"] if stats["elapsed"] else 0.0
+    stats["limit"] = limit.current()
+    print(f"{stats['succeeded']} succeeded, {stats['failed']} failed, {stats['throttled']} throttled; "
+          f"{stats['requests_per_second']:.1f} requests/s, final concurrency {stats['limit']}")
+    return stats
@@ -0,0 +1,204 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from src import fhir_loader, resilience, token_provider
+from src.condition_migration import add_conditions
+from src.fhir_search import BASE_URL, DEFAULT_WORKERS, chunked
+from src.registration import data_dir
+from src.task_1 import transform_patient
+
+# FHIR Bulk Data Access ($export) client for OpenEMR. The kick-off request returns a status URL which is
+# polled until the server publishes a manifest of NDJSON files; those are downloaded in parallel and
+# streamed to disk, then read back one resource at a time and loaded into Primary Care through the same
+# transforms as the paged extraction.
+EXPORT_DIR = data_dir / "export"
+POLL_INTERVAL = 5
+MAX_POLL_INTERVAL = 120
+# Polling gives up after this many failed status requests in a row, or once the export has run this long
+MAX_POLL_ERRORS = 10
+EXPORT_TIMEOUT = 6 * 60 * 60
+CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_ATTEMPTS = 3
+# Conditions whose SNOMED codes are resolved together before they are added to the Bundles
+CONDITIONS_PER_CHUNK = 500
+
+
+def start_export(resource_types=None, since=None, patient_level=True):
+    """
+    Kicks off Patient/$export (or system-level $export) and returns the status URL, or None on failure.
+    """
+    url = f'{BASE_URL}/Patient/$export' if patient_level else f'{BASE_URL}/$export'
+    params = {}
+    if resource_types:
+        params['_type'] = ','.join(resource_types)
+    if since:
+        params['_since'] = since
+    headers = {
+        "Accept": "application/fhir+json",
+        "Prefer": "respond-async",
+    }
+    try:
+        response = token_provider.get(url=url, params=params, headers=headers)
+        if response.status_code == 202:
+            return response.headers.get('Content-Location')
+        print(f"Failed to start export. Status code: {response.status_code}")
+        print(f"Response Text: {response.text}")
+    except requests.exceptions.RequestException as e:
+        print(f"Error starting export: {e}")
+    return None
+
+
+def get_poll_delay(response):
+    retry_after = resilience.get_retry_after(response)
+    if retry_after is None:
+        return POLL_INTERVAL
+    return min(max(retry_after, 1), MAX_POLL_INTERVAL)
+
+
+def wait_for_export(status_url, timeout=EXPORT_TIMEOUT):
+    """
+    Polls the status URL, honouring Retry-After, until the export completes. Returns the manifest, or None
+    when the export failed, MAX_POLL_ERRORS status requests in a row failed or timeout seconds have passed.
+    """
+    deadline = time.monotonic() + timeout
+    errors = 0
+    while time.monotonic() < deadline:
+        try:
+            response = token_provider.get(url=status_url, headers={"Accept": "application/json"})
+        except requests.exceptions.RequestException as e:
+            errors += 1
+            print(f"Error polling export status ({errors} of {MAX_POLL_ERRORS}): {e}")
+            if errors >= MAX_POLL_ERRORS:
+                return None
+            time.sleep(POLL_INTERVAL)
+            continue
+        errors = 0
+        if response.status_code == 202:
+            print(f"Export in progress: {response.headers.get('X-Progress', '')}")
+            time.sleep(min(get_poll_delay(response), max(0.0, deadline - time.monotonic())))
+        elif response.status_code == 200:
+            return response.json()
+        else:
+            print(f"Export failed. Status code: {response.status_code}")
+            print(f"Response Text: {response.text}")
+            return None
+    print(f"Export did not complete within {timeout} seconds; status URL {status_url}")
+    return None
+
+
+def download_file(url, path, attempts=DOWNLOAD_ATTEMPTS):
+    """
+    Streams one NDJSON output file to disk without holding it in memory. A failed download is restarted up
+    to attempts times in all. Returns the path, or None if every attempt failed.
+    """
+    for attempt in range(1, attempts + 1):
+        try:
+            with token_provider.get(url=url, headers={"Accept": "application/fhir+ndjson"}, stream=True) as response:
+                response.raise_for_status()
+                with open(path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+            return path
+        except (requests.exceptions.RequestException, OSError) as e:
+            print(f"Downloading {url} failed (attempt {attempt} of {attempts}): {e}")
+            if attempt < attempts:
+                time.sleep(POLL_INTERVAL)
+    path.unlink(missing_ok=True)
+    return None
+
+
+def download_outputs(manifest, output_dir=None, max_workers=DEFAULT_WORKERS):
+    """
+    Downloads every file listed in the manifest concurrently. Returns a dict of resource type to file paths
+    and the list of URLs that could not be downloaded.
+    """
+    output_dir = output_dir or EXPORT_DIR
+    output_dir.mkdir(parents=True, exist_ok=True)
+    outputs = manifest.get('output', [])
+    paths = [output_dir / f"{item['type']}_{number}.ndjson" for number, item in enumerate(outputs)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(download_file, [item['url'] for item in outputs], paths))
+    files = {}
+    failed = []
+    for item, path in zip(outputs, results):
+        if path is None:
+            failed.append(item['url'])
+        else:
+            files.setdefault(item['type'], []).append(path)
+    return files, failed
+
+
+def delete_export(status_url):
+    try:
+        token_provider.request("DELETE", status_url)
+    except requests.exceptions.RequestException as e:
+        print(f"Error deleting export: {e}")
+
+
+def export(resource_types=None, since=None, patient_level=True, output_dir=None, max_workers=DEFAULT_WORKERS):
+    """
+    Runs a complete bulk export. Returns a dict of resource type to downloaded NDJSON paths and the list of
+    file URLs that failed; the files that did download are kept either way. When a file failed the export
+    is left on the server so its files can still be fetched from the printed status URL.
+    """
+    status_url = start_export(resource_types, since, patient_level)
+    if status_url is None:
+        return {}, []
+    manifest = wait_for_export(status_url)
+    if manifest is None:
+        return {}, []
+    for error in manifest.get('error', []):
+        print(f"Export reported an error file: {error.get('url')}")
+    files, failed = download_outputs(manifest, output_dir, max_workers)
+    if failed:
+        print(f"{len(failed)} of {len(manifest.get('output', []))} file(s) could not be downloaded; "
+              f"export kept at {status_url}")
+    else:
+        delete_export(status_url)
+    return files, failed
+
+
+def iter_ndjson(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_exported_resources(files, resource_type):
+    """
+    Yields the exported resources of one type across all of its NDJSON files.
+    """
+    for path in files.get(resource_type, []):
+        yield from iter_ndjson(path)
+
+
+def load_exported(files, include_children=True, bundle_size=fhir_loader.DEFAULT_BUNDLE_SIZE):
+    """
+    Loads exported Patients and their Conditions into Primary Care with the task_1/task_2 transforms: Patients
+    in transaction Bundles, then Conditions as their SNOMED parent (and child) in batch Bundles, with the
+    codes of CONDITIONS_PER_CHUNK conditions resolved at a time. Returns the (loaded, failed) counts.
+    """
+    failed = 0
+    with fhir_loader.BundleLoader('transaction', bundle_size) as loader:
+        for patient in iter_exported_resources(files, 'Patient'):
+            try:
+                loader.add(transform_patient(patient), source_reference=f"Patient/{patient['id']}")
+            except (KeyError, IndexError) as e:
+                print(f"Error: could not transform Patient/{patient.get('id')}: missing {e}")
+                failed += 1
+    loaded, failed = loader.loaded, failed + loader.failed
+    print(f"Patients: {loaded} loaded, {failed} failed")
+    with fhir_loader.BundleLoader('batch', bundle_size) as loader:
+        for conditions in chunked(iter_exported_resources(files, 'Condition'), CONDITIONS_PER_CHUNK):
+            add_conditions(loader, conditions, include_children)
+    print(f"Conditions: {loader.loaded} loaded, {loader.failed} failed")
+    return loaded + loader.loaded, failed + loader.failed
+
+
+if __name__ == '__main__':
+    exported_files, failed_files = export(resource_types=['Patient', 'Condition'])
+    for exported_type, exported_paths in exported_files.items():
+        print(f"{exported_type}: {len(exported_paths)} file(s)")
+    load_exported(exported_files)
@@ -0,0 +1,102 @@
+from src import fhir_loader, id_mapping
+from src.fhir_search import (DEFAULT_PAGE_SIZE, DEFAULT_WORKERS, IncompleteSearchError, chunked, iter_resources,
+                              run_concurrently)
+from src.snomed_parent import resolve_concepts, resolve_parents_and_children
+from src.task_1 import get_condition_code, transform_condition
+from src.task_2 import transform_child_condition
+
+# Cohort-level condition migration. Instead of one Condition search per patient that keeps only the first
+# entry, the Conditions of PATIENTS_PER_SEARCH patients are fetched with one comma-OR search
+# (patient=a,b,c), every page of it is followed, and the cohorts are searched concurrently. Each cohort's
+# codes are resolved to their SNOMED parent/child in one de-duplicated batch and the resulting Conditions
+# are loaded in batch Bundles.
+# Keeps the search URL well under common 8 KB limits with 36-character OpenEMR UUIDs
+PATIENTS_PER_SEARCH = 50
+
+
+def search_cohort_conditions(patient_ids, count=DEFAULT_PAGE_SIZE):
+    """
+    Returns every Condition of the given OpenEMR patients, following paging. Raises IncompleteSearchError if
+    a page could not be fetched, so a cohort is never migrated with part of its Conditions.
+    """
+    return list(iter_resources('Condition', {'patient': ','.join(patient_ids)}, count, prefetch=False, strict=True))
+
+
+def try_search_cohort_conditions(patient_ids):
+    """
+    search_cohort_conditions for the concurrent cohort searches: returns None after printing the error when
+    the search is incomplete.
+    """
+    try:
+        return search_cohort_conditions(patient_ids)
+    except IncompleteSearchError as e:
+        print(f"Error: skipping a cohort of {len(patient_ids)} patient(s): {e}")
+        return None
+
+
+def add_conditions(loader, conditions, include_children=True):
+    """
+    Resolves the codes of a group of OpenEMR Conditions in one de-duplicated batch and adds their parent (and,
+    with include_children, child) Conditions to a batch BundleLoader. Conditions whose patient is not loaded,
+    that have no code or whose code does not resolve are logged and counted in loader.failed.
+    """
+    subjects = id_mapping.get_references(condition['subject']['reference'] for condition in conditions)
+    codes = [get_condition_code(condition) for condition in conditions]
+    if include_children:
+        parents, children = resolve_parents_and_children(codes)
+    else:
+        parents, children = resolve_concepts(codes, 'parent'), {}
+    for condition, code in zip(conditions, codes):
+        subject_reference = subjects.get(condition['subject']['reference'])
+        if subject_reference is None:
+            print(f"Error: {condition['subject']['reference']} has not been loaded into Primary Care.")
+            loader.failed += 1
+            continue
+        if code is None:
+            print(f"Error: Condition/{condition['id']} has no code.")
+            loader.failed += 1
+            continue
+        concepts = [('parent', parents.get(code))]
+        if include_children:
+            concepts.append(('child', children.get(code)))
+        for relation, concept in concepts:
+            if concept is None:
+                print(f"Error: no SNOMED {relation} for Condition/{condition['id']} (code {code}).")
+                loader.failed += 1
+                continue
+            try:
+                if relation == 'parent':
+                    loader.add(transform_condition(condition, subject_reference, concept),
+                               f"Condition/{condition['id']}")
+                else:
+                    loader.add(transform_child_condition(condition, subject_reference, concept))
+            except Exception as e:
+                print(f"Error: could not transform Condition/{condition['id']} ({relation}): {e}")
+                loader.failed += 1
+
+
+def migrate_conditions(patient_ids=None, include_children=True, patients_per_search=PATIENTS_PER_SEARCH,
+                       bundle_size=fhir_loader.DEFAULT_BUNDLE_SIZE, max_workers=DEFAULT_WORKERS):
+    """
+    Migrates all Conditions of the given OpenEMR patients (by default every patient already loaded into
+    Primary Care) as their SNOMED parent and, with include_children, their SNOMED child. Returns the
+    (loaded, failed) counts; a cohort whose Condition search was incomplete counts as one failure.
+    """
+    if patient_ids is None:
+        patient_ids = id_mapping.get_source_ids('Patient')
+    tasks = (
+        lambda cohort=cohort: try_search_cohort_conditions(cohort)
+        for cohort in chunked(patient_ids, patients_per_search)
+    )
+    with fhir_loader.BundleLoader('batch', bundle_size) as loader:
+        for conditions in run_concurrently(tasks, max_workers, ordered=False):
+            if conditions is None:
+                loader.failed += 1
+                continue
+            add_conditions(loader, conditions, include_children)
+    print(f"Conditions: {loader.loaded} loaded, {loader.failed} failed")
+    return loader.loaded, loader.failed
+
+
+if __name__ == '__main__':
+    migrate_conditions()
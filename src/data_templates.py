@@ -1,3 +1,6 @@
+from dataclasses import dataclass
+from typing import Optional
+
 patient_template_dict = {
     "resourceType": "Patient",
     "identifier": [
@@ -52,6 +55,12 @@ patient_template_dict = {
 
 condition_template_dict = {
     "resourceType": "Condition",
+    "identifier": [
+        {
+            "system": "urn:ietf:rfc:3986",
+            "value": ""  ###
+        }
+    ],
     "clinicalStatus": {
         "coding": [
             {
@@ -88,8 +97,8 @@ condition_template_dict = {
         "coding": [
             {
                 "system": "http://snomed.info/sct",
-                "code": "",
-                "display": ""
+                "code": "N/A",
+                "display": "Not Applicable"
             }
         ]
     },
@@ -108,11 +117,11 @@ condition_template_dict = {
             "coding": [
                 {
                     "system": "http://snomed.info/sct",
-                    "code": "",
-                    "display": ""
+                    "code": "N/A",
+                    "display": "Not Applicable"
                 }
             ],
-            "text": ""
+            "text": "Not Applicable"
         }
     ],
     "subject": {
@@ -121,3 +130,104 @@ condition_template_dict = {
     "onsetDateTime": ""
 }
 
+
+# Compiled builders. A template is compiled once against the paths of its variable fields; the resulting
+# builder creates new containers only along those paths and shares every other (static) subtree of the
+# template between all resources it builds. Built resources are therefore cheap and independent of each
+# other, but their static parts must be treated as read-only: copy a subtree before changing it.
+def compile_builder(template, fields):
+    """
+    Compiles a template into a function taking a dict of field values. fields maps each field name to its
+    path in the template, e.g. {'family': ('name', 0, 'family')}.
+    """
+    return compile_node(template, [(tuple(path), name) for name, path in fields.items()])
+
+
+def compile_node(template, slots):
+    if not slots:
+        return lambda values: template
+    for path, name in slots:
+        if not path:
+            return lambda values: values[name]
+    children = {}
+    for path, name in slots:
+        children.setdefault(path[0], []).append((path[1:], name))
+    if isinstance(template, dict):
+        builders = [(key, compile_node(value, children.get(key, []))) for key, value in template.items()]
+        return lambda values: {key: build(values) for key, build in builders}
+    builders = [compile_node(value, children.get(number, [])) for number, value in enumerate(template)]
+    return lambda values: [build(values) for build in builders]
+
+
+@dataclass(frozen=True)
+class PatientFields:
+    identifier_value: str
+    # None leaves the identifier period out
+    identifier_start: Optional[str]
+    family: str
+    given: str
+    gender: str
+    birth_date: str
+    line: str = ''
+    city: str = ''
+    district: str = 'N/A'
+    state: str = ''
+    postal_code: str = ''
+    text: str = ''
+
+
+@dataclass(frozen=True)
+class ConditionFields:
+    identifier_value: str
+    code: str
+    term: str
+    verification_status: str
+    subject_reference: str
+    # None leaves onsetDateTime out
+    onset: Optional[str]
+
+
+_build_patient = compile_builder(patient_template_dict, {
+    'identifier_value': ('identifier', 0, 'value'),
+    'identifier_start': ('identifier', 0, 'period', 'start'),
+    'family': ('name', 0, 'family'),
+    'given': ('name', 0, 'given', 0),
+    'gender': ('gender',),
+    'birth_date': ('birthDate',),
+    'line': ('address', 0, 'line', 0),
+    'city': ('address', 0, 'city'),
+    'district': ('address', 0, 'district'),
+    'state': ('address', 0, 'state'),
+    'postal_code': ('address', 0, 'postalCode'),
+    'text': ('address', 0, 'text'),
+})
+
+_build_condition = compile_builder(condition_template_dict, {
+    'identifier_value': ('identifier', 0, 'value'),
+    'code': ('code', 'coding', 0, 'code'),
+    'term': ('code', 'coding', 0, 'display'),
+    'code_text': ('code', 'text'),
+    'verification_status': ('verificationStatus', 'coding', 0, 'code'),
+    'subject_reference': ('subject', 'reference'),
+    'onset': ('onsetDateTime',),
+})
+
+
+def build_patient(fields):
+    """
+    Returns a new Patient resource built from PatientFields.
+    """
+    patient = _build_patient(vars(fields))
+    if fields.identifier_start is None:
+        patient['identifier'] = [{key: value for key, value in patient['identifier'][0].items() if key != 'period'}]
+    return patient
+
+
+def build_condition(fields):
+    """
+    Returns a new Condition resource built from ConditionFields.
+    """
+    condition = _build_condition({**vars(fields), 'code_text': fields.term})
+    if fields.onset is None:
+        del condition['onsetDateTime']
+    return condition
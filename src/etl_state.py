@@ -0,0 +1,152 @@
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from src.fhir_search import DEFAULT_PAGE_SIZE, get_next_link, iter_pages
+from src.registration import data_dir
+
+# Per-resource-type high-water marks for incremental extraction. Each run asks OpenEMR for resources with
+# _lastUpdated at or after the stored mark (ge, so resources sharing the mark's instant are not missed) and
+# skips the ones already loaded at exactly that instant. The mark only moves up to the first resource that
+# failed to load, so failed resources are picked up again by the next run.
+STATE_PATH = data_dir / "etl_state.sqlite"
+
+_state_lock = threading.Lock()
+_connection = None
+
+
+def get_connection():
+    global _connection
+    if _connection is None:
+        STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        _connection = sqlite3.connect(str(STATE_PATH), check_same_thread=False)
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS watermarks ("
+            "resource_type TEXT PRIMARY KEY, last_updated TEXT NOT NULL, loaded INTEGER NOT NULL, "
+            "updated_at REAL NOT NULL, boundary_ids TEXT NOT NULL DEFAULT '[]')"
+        )
+        columns = [row[1] for row in _connection.execute("PRAGMA table_info(watermarks)")]
+        if 'boundary_ids' not in columns:
+            _connection.execute("ALTER TABLE watermarks ADD COLUMN boundary_ids TEXT NOT NULL DEFAULT '[]'")
+        _connection.commit()
+    return _connection
+
+
+def get_watermark(resource_type):
+    """
+    Returns the stored _lastUpdated mark of a resource type, or None if it was never synced.
+    """
+    return get_watermark_state(resource_type)[0]
+
+
+def get_watermark_state(resource_type):
+    """
+    Returns (mark, IDs of the resources already loaded whose lastUpdated is exactly the mark).
+    """
+    with _state_lock:
+        row = get_connection().execute(
+            "SELECT last_updated, boundary_ids FROM watermarks WHERE resource_type = ?", (resource_type,)
+        ).fetchone()
+    return (row[0], set(json.loads(row[1]))) if row else (None, set())
+
+
+def set_watermark(resource_type, last_updated, loaded=0, boundary_ids=()):
+    with _state_lock:
+        connection = get_connection()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO watermarks (resource_type, last_updated, loaded, updated_at, boundary_ids) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (resource_type, last_updated, loaded, time.time(), json.dumps(sorted(boundary_ids)))
+            )
+
+
+def reset_watermark(resource_type=None):
+    """
+    Forgets the mark of one resource type, or of all of them, so the next run is a full extract.
+    """
+    with _state_lock:
+        connection = get_connection()
+        with connection:
+            if resource_type is None:
+                connection.execute("DELETE FROM watermarks")
+            else:
+                connection.execute("DELETE FROM watermarks WHERE resource_type = ?", (resource_type,))
+
+
+def parse_instant(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def incremental_params(resource_type, params=None):
+    """
+    Adds _lastUpdated=ge<watermark> to the search parameters when the resource type has been synced before.
+    """
+    params = dict(params or {})
+    watermark = get_watermark(resource_type)
+    if watermark:
+        params['_lastUpdated'] = f'ge{watermark}'
+    return params
+
+
+def load_resource(resource_type, load, resource):
+    try:
+        return bool(load(resource))
+    except Exception as e:
+        print(f"Loading {resource_type}/{resource.get('id')} raised: {e}")
+        return False
+
+
+def run_incremental(resource_type, load, params=None, count=DEFAULT_PAGE_SIZE):
+    """
+    Extracts the resources changed since the last successful run and passes each one to load, which returns
+    True once the resource is stored on the target server. A resource that fails (or raises) does not stop
+    the run. If every page was read, the watermark is advanced to the newest meta.lastUpdated seen, or, when
+    loads failed, to the lastUpdated of the earliest failed resource so that it is extracted again. Returns
+    the number of resources loaded.
+    """
+    watermark, boundary_ids = get_watermark_state(resource_type)
+    watermark_instant = parse_instant(watermark) if watermark else None
+    # Newest lastUpdated loaded so far and the IDs loaded at exactly that instant
+    high_water, high_water_ids = watermark, set()
+    earliest_failure = None
+    unplaced_failure = False
+    loaded = failed = 0
+    last_bundle = None
+    for bundle in iter_pages(resource_type, incremental_params(resource_type, params), count):
+        last_bundle = bundle
+        for entry in bundle.get('entry', []):
+            resource = entry['resource']
+            last_updated = resource.get('meta', {}).get('lastUpdated')
+            instant = parse_instant(last_updated) if last_updated else None
+            already_loaded = (instant is not None and instant == watermark_instant
+                              and resource.get('id') in boundary_ids)
+            if not already_loaded:
+                if not load_resource(resource_type, load, resource):
+                    failed += 1
+                    if instant is None:
+                        unplaced_failure = True
+                    elif earliest_failure is None or instant < parse_instant(earliest_failure):
+                        earliest_failure = last_updated
+                    continue
+                loaded += 1
+            if instant is None:
+                continue
+            if high_water is None or instant > parse_instant(high_water):
+                high_water, high_water_ids = last_updated, {resource.get('id')}
+            elif instant == parse_instant(high_water):
+                high_water_ids.add(resource.get('id'))
+    if last_bundle is None or get_next_link(last_bundle):
+        print(f"Extracting {resource_type} did not complete; watermark left at {watermark}")
+        return loaded
+    if unplaced_failure:
+        print(f"{resource_type}: a resource without meta.lastUpdated failed; watermark left at {watermark}")
+        return loaded
+    if earliest_failure is not None:
+        # Everything from the earliest failure on is extracted again; conditional updates make reloads no-ops
+        high_water, high_water_ids = earliest_failure, set()
+    if high_water != watermark or high_water_ids:
+        set_watermark(resource_type, high_water, loaded, high_water_ids)
+    print(f"{resource_type}: {loaded} changed resource(s) loaded, {failed} failed, watermark {high_water}")
+    return loaded
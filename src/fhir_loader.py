@@ -0,0 +1,253 @@
+import uuid
+from urllib.parse import urlencode
+import requests
+from src import http_client, id_mapping
+from src.fhir_search import BASE_URL
+
+# Idempotent loads into the Primary Care FHIR server. Every loaded resource carries an identifier derived
+# deterministically from where it came from in OpenEMR, and is written with a conditional create
+# (If-None-Exist) or conditional update (PUT ?identifier=...), so a rerun or retry matches the resource
+# created the first time instead of adding a duplicate. BundleLoader sends many of these writes in one
+# transaction or batch Bundle.
+BASE_PRIMARY_CARE_URL = "http://137.184.71.65:8080/fhir"
+URI_IDENTIFIER_SYSTEM = "urn:ietf:rfc:3986"
+DEFAULT_BUNDLE_SIZE = 200
+
+
+def derived_identifier_value(*parts):
+    """
+    Returns a stable urn:uuid (UUID version 5) for the given key parts. The same parts always give the
+    same value, on every machine and every run.
+    """
+    return f"urn:uuid:{uuid.uuid5(uuid.NAMESPACE_URL, '/'.join(str(part) for part in parts))}"
+
+
+def source_identifier_value(resource_type, source_id, variant=None):
+    """
+    Identifier value for a resource loaded from OpenEMR resource_type/source_id. variant tells apart several
+    target resources made from one source resource, such as the parent and child Conditions.
+    """
+    source_url = f"{BASE_URL}/{resource_type}/{source_id}"
+    return derived_identifier_value(f"{source_url}#{variant}" if variant else source_url)
+
+
+def identifier_search(identifier):
+    """
+    Returns the URL-encoded identifier=system|value query matching one identifier.
+    """
+    return urlencode({'identifier': f"{identifier['system']}|{identifier['value']}"})
+
+
+def get_resource_id(response):
+    """
+    Reads the logical ID of a created or updated resource from the response body, or from the Location
+    header when the server returns no body.
+    """
+    try:
+        resource_id = response.json().get('id')
+        if resource_id:
+            return resource_id
+    except ValueError:
+        pass
+    location = response.headers.get('Location') or response.headers.get('Content-Location')
+    if location:
+        return location.split('/_history/')[0].rstrip('/').rsplit('/', 1)[-1]
+    return None
+
+
+def conditional_create(resource, identifier=None, base_url=BASE_PRIMARY_CARE_URL):
+    """
+    POSTs a resource with If-None-Exist on its (first) identifier. The server creates it only if no resource
+    with that identifier exists. Returns the ID of the created or existing resource, or None on failure.
+    """
+    identifier = identifier or resource['identifier'][0]
+    headers = {
+        "Accept": 'application/json',
+        "If-None-Exist": identifier_search(identifier),
+    }
+    url = f"{base_url}/{resource['resourceType']}"
+    try:
+        response = http_client.post(url=url, json=resource, headers=headers)
+        if response.status_code in [200, 201]:
+            return get_resource_id(response)
+        print(f"Failed to create {resource['resourceType']}. Status code: {response.status_code}")
+        print(f"Response Text: {response.text}")
+    except requests.exceptions.RequestException as e:
+        print(f"Error during request: {e}")
+    return None
+
+
+def conditional_update(resource, identifier=None, base_url=BASE_PRIMARY_CARE_URL):
+    """
+    PUTs a resource to [type]?identifier=... so the server updates the resource with that identifier, or
+    creates it if there is none. Returns the resource ID, or None on failure.
+    """
+    identifier = identifier or resource['identifier'][0]
+    url = f"{base_url}/{resource['resourceType']}?{identifier_search(identifier)}"
+    try:
+        response = http_client.request("PUT", url, json=resource, headers={"Accept": 'application/json'})
+        if response.status_code in [200, 201]:
+            return get_resource_id(response)
+        print(f"Failed to update {resource['resourceType']}. Status code: {response.status_code}")
+        print(f"Response Text: {response.text}")
+    except requests.exceptions.RequestException as e:
+        print(f"Error during request: {e}")
+    return None
+
+
+def entry_request(resource, conditional='update'):
+    """
+    Returns the Bundle.entry.request of a conditional update or conditional create on the resource identifier.
+    """
+    search = identifier_search(resource['identifier'][0])
+    if conditional == 'update':
+        return {"method": "PUT", "url": f"{resource['resourceType']}?{search}"}
+    return {"method": "POST", "url": resource['resourceType'], "ifNoneExist": search}
+
+
+def rewrite_references(value, references):
+    """
+    Returns the value with every Reference.reference found in references (a dict of old to new reference)
+    replaced. Only the containers on the way to a replaced reference are copied; the input is not modified,
+    so resources that share static parts (see data_templates.compile_builder) stay intact.
+    """
+    if isinstance(value, dict):
+        changed = {}
+        for key, item in value.items():
+            if key == 'reference' and isinstance(item, str) and item in references:
+                changed[key] = references[item]
+            elif isinstance(item, (dict, list)):
+                new_item = rewrite_references(item, references)
+                if new_item is not item:
+                    changed[key] = new_item
+        return {**value, **changed} if changed else value
+    if isinstance(value, list):
+        items = [rewrite_references(item, references) for item in value]
+        return items if any(new is not old for new, old in zip(items, value)) else value
+    return value
+
+
+class BundleLoader:
+    """
+    Collects resources into transaction or batch Bundles of bundle_size entries and posts each full Bundle in
+    one request. Entries get a urn:uuid fullUrl (their identifier value), so in a transaction a Condition,
+    Observation or Procedure can reference a Patient added to the same Bundle. Entries added with a
+    source_reference are recorded in the ID mapping once the server reports the ID it assigned.
+
+    A batch Bundle lets entries fail independently but cannot resolve urn:uuid references between them, so
+    use it only for resources whose references are already resolved.
+    """
+
+    def __init__(self, bundle_type='transaction', bundle_size=DEFAULT_BUNDLE_SIZE, conditional='update',
+                 base_url=BASE_PRIMARY_CARE_URL):
+        self.bundle_type = bundle_type
+        self.bundle_size = bundle_size
+        self.conditional = conditional
+        self.base_url = base_url
+        self.entries = []
+        self.sources = []
+        self.pending = {}
+        self.flushed = {}
+        self.loaded = 0
+        self.failed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Batch entries stand on their own, so what was queued before an error is still sent; a transaction
+        # is only sent complete
+        if exc_type is None or (self.bundle_type == 'batch' and issubclass(exc_type, Exception)):
+            self.flush()
+
+    def resolve_reference(self, source_reference):
+        """
+        Returns the reference to use for an OpenEMR resource: the fullUrl of an entry waiting in the current
+        Bundle, or the Primary Care reference from the ID mapping. None if it has not been added or loaded.
+        """
+        if source_reference in self.pending:
+            return self.pending[source_reference]
+        return id_mapping.get_reference(source_reference)
+
+    def add(self, resource, source_reference=None, conditional=None):
+        """
+        Queues the resource and returns its fullUrl. The Bundle is sent when it is full. The resource must not
+        be changed afterwards.
+        """
+        if len(self.entries) >= self.bundle_size:
+            self.flush()
+        # References to entries of an already sent Bundle point at the IDs the server assigned to them
+        if self.flushed:
+            resource = rewrite_references(resource, self.flushed)
+        full_url = resource['identifier'][0]['value']
+        self.entries.append({
+            "fullUrl": full_url,
+            "resource": resource,
+            "request": entry_request(resource, conditional or self.conditional),
+        })
+        self.sources.append(source_reference)
+        if source_reference is not None:
+            self.pending[source_reference] = full_url
+        return full_url
+
+    def flush(self):
+        """
+        Posts the queued entries as one Bundle and records the assigned IDs. Returns the list of target
+        references in entry order, with None for entries that failed.
+        """
+        if not self.entries:
+            return []
+        bundle = {"resourceType": "Bundle", "type": self.bundle_type, "entry": self.entries}
+        entries, sources = self.entries, self.sources
+        self.entries, self.sources, self.pending = [], [], {}
+        references = [None] * len(entries)
+        try:
+            response = http_client.post(url=self.base_url, json=bundle, headers={"Accept": 'application/json'})
+            if response.status_code == 200:
+                references = [get_entry_reference(entry) for entry in response.json().get('entry', [])]
+                references += [None] * (len(entries) - len(references))
+            else:
+                print(f"Failed to post {self.bundle_type} Bundle. Status code: {response.status_code}")
+                print(f"Response Text: {response.text}")
+        except requests.exceptions.RequestException as e:
+            print(f"Error during request: {e}")
+        mapped = {}
+        for entry, source_reference, reference in zip(entries, sources, references):
+            if reference is None:
+                self.failed += 1
+                continue
+            self.loaded += 1
+            self.flushed[entry['fullUrl']] = reference
+            if source_reference is not None:
+                resource_type, _, source_id = source_reference.partition('/')
+                mapped.setdefault(resource_type, []).append((source_id, reference.split('/', 1)[1]))
+        for resource_type, pairs in mapped.items():
+            id_mapping.set_target_ids(resource_type, pairs)
+        print(f"{self.bundle_type} Bundle: {len(entries) - references.count(None)} of {len(entries)} entries loaded")
+        return references
+
+
+def get_entry_reference(response_entry):
+    """
+    Returns 'Type/id' from a Bundle response entry, or None if that entry failed.
+    """
+    entry_response = response_entry.get('response', {})
+    if not entry_response.get('status', '').startswith('2'):
+        print(f"Bundle entry failed: {entry_response.get('status')} {entry_response.get('outcome', '')}")
+        return None
+    location = entry_response.get('location')
+    if not location:
+        resource = response_entry.get('resource', {})
+        return f"{resource['resourceType']}/{resource['id']}" if 'id' in resource else None
+    resource_type, resource_id = location.split('/_history/')[0].rstrip('/').split('/')[-2:]
+    return f"{resource_type}/{resource_id}"
+
+
+def load_bundles(resources, bundle_type='transaction', bundle_size=DEFAULT_BUNDLE_SIZE, conditional='update'):
+    """
+    Loads an iterable of (resource, source_reference) pairs in Bundles. Returns (loaded, failed) counts.
+    """
+    with BundleLoader(bundle_type, bundle_size, conditional) as loader:
+        for resource, source_reference in resources:
+            loader.add(resource, source_reference)
+    return loader.loaded, loader.failed
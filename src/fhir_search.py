@@ -0,0 +1,320 @@
+import json
+import queue
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+import requests
+from src import token_provider
+
+# Streaming search over any OpenEMR FHIR resource type. Pages are yielded one at a time and the next
+# page is fetched in the background while the caller processes the current one.
+BASE_URL = "https://in-info-web20.luddy.indianapolis.iu.edu/apis/default/fhir"
+DEFAULT_PAGE_SIZE = 100
+PAGE_TIMEOUT = 180
+DEFAULT_WORKERS = 8
+# Elements a server always returns with _elements; client-side pruning keeps them too
+MANDATORY_ELEMENTS = frozenset(('resourceType', 'id', 'meta'))
+# Pages a partition worker may have waiting for the consumer before it stops fetching
+PARTITION_QUEUE_SIZE = 2
+
+_PARTITION_END = object()
+
+
+class IncompleteSearchError(Exception):
+    """
+    Raised by iter_pages_parallel after the last page it could fetch when some _offset windows or
+    partitions failed, so a full-table extraction never passes for complete on partial data.
+    """
+
+    def __init__(self, resource_type, failed):
+        super().__init__(f"{resource_type} search incomplete; failed: {', '.join(map(str, failed))}")
+        self.resource_type = resource_type
+        self.failed = failed
+
+
+def get_next_link(bundle):
+    """
+    Returns the URL of the link with relation 'next', or None on the last page.
+    """
+    for link in bundle.get('link', []):
+        if link.get('relation') == 'next':
+            return link.get('url')
+    return None
+
+
+def projection_params(params=None, elements=None, summary=None):
+    """
+    Adds the _elements (a sequence of element names) or _summary (e.g. 'data') projection to search parameters.
+    """
+    params = dict(params or {})
+    if elements:
+        params['_elements'] = ','.join(elements)
+    if summary:
+        params['_summary'] = summary
+    return params
+
+
+def prune_resource(resource, elements=None, summary=None):
+    """
+    Applies a projection on the client, for servers that ignore _elements/_summary. Returns the resource
+    itself when there is nothing to remove.
+    """
+    if elements:
+        keep = MANDATORY_ELEMENTS.union(elements)
+        if not keep.issuperset(resource):
+            return {key: value for key, value in resource.items() if key in keep}
+    elif summary == 'data' and 'text' in resource:
+        return {key: value for key, value in resource.items() if key != 'text'}
+    return resource
+
+
+def prune_bundle(bundle, elements=None, summary=None):
+    """
+    Prunes the matched resources of a search Bundle in place; _include/_revinclude resources are kept whole.
+    """
+    if elements or summary:
+        for entry in bundle.get('entry', []):
+            if 'resource' in entry and entry.get('search', {}).get('mode') != 'include':
+                entry['resource'] = prune_resource(entry['resource'], elements, summary)
+    return bundle
+
+
+def fetch_bundle(url, params=None, elements=None, summary=None):
+    """
+    Fetches one search page. Returns the Bundle, or None after printing the error. elements/summary prune
+    the resources in case the server did not apply the projection itself.
+    """
+    response = None
+    try:
+        response = token_provider.get(url=url, params=params, timeout=PAGE_TIMEOUT)
+        print(f"Requesting URL: {response.url}")
+        if response.status_code == 200:
+            return prune_bundle(response.json(), elements, summary)
+        print(f"Failed to retrieve {url}. Status code: {response.status_code}")
+        print(f"Response Text: {response.text}")
+    except requests.exceptions.Timeout:
+        print("Request timed out. Please check the server or your network connection.")
+    except requests.exceptions.RequestException as e:
+        print(f"An error occurred: {e}")
+    except json.JSONDecodeError:
+        print(f"Error decoding JSON from the response. Response text: {response.text}")
+    return None
+
+
+def iter_pages(resource_type, params=None, count=DEFAULT_PAGE_SIZE, prefetch=True, base_url=BASE_URL, elements=None,
+               summary=None, strict=False):
+    """
+    Yields the search Bundles of a resource type page by page. count sets _count; with prefetch the
+    next page is requested while the caller is still working on the current one. elements (e.g.
+    ('gender', 'birthDate')) or summary ('data', 'true') ask the server for a projection. A page that
+    cannot be fetched ends the paging; with strict IncompleteSearchError is raised after the last page
+    that could be fetched.
+    """
+    params = projection_params(params, elements, summary)
+    if count:
+        params.setdefault('_count', count)
+    bundle = fetch_bundle(f'{base_url}/{resource_type}', params, elements, summary)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        while bundle is not None:
+            next_url = get_next_link(bundle)
+            next_page = executor.submit(fetch_bundle, next_url, None, elements, summary) if next_url and prefetch else None
+            yield bundle
+            if next_url is None:
+                break
+            bundle = next_page.result() if next_page else fetch_bundle(next_url, None, elements, summary)
+    if strict and bundle is None:
+        raise IncompleteSearchError(resource_type, ["a page of the search"])
+
+
+def iter_resources(resource_type, params=None, count=DEFAULT_PAGE_SIZE, prefetch=True, base_url=BASE_URL,
+                   elements=None, summary=None, strict=False):
+    """
+    Yields the resources of every page, holding at most two pages in memory at a time.
+    """
+    for bundle in iter_pages(resource_type, params, count, prefetch, base_url, elements, summary, strict):
+        for entry in bundle.get('entry', []):
+            yield entry['resource']
+
+
+def get_total(resource_type, params=None, base_url=BASE_URL):
+    """
+    Returns the number of matching resources using _summary=count, or None if the server does not report it.
+    """
+    params = dict(params or {})
+    params['_summary'] = 'count'
+    bundle = fetch_bundle(f'{base_url}/{resource_type}', params)
+    return bundle.get('total') if bundle is not None else None
+
+
+def chunked(items, size):
+    """
+    Splits an iterable into lists of at most size items, e.g. IDs for comma-OR searches.
+    """
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def range_partitions(search_param, boundaries):
+    """
+    Splits a date search parameter (birthdate, _lastUpdated) into disjoint ranges at the given boundaries,
+    open-ended at both ends. Resources without a value for the parameter are not matched by any range.
+    """
+    boundaries = list(boundaries)
+    if not boundaries:
+        return [{}]
+    partitions = [{search_param: f'lt{boundaries[0]}'}]
+    for low, high in zip(boundaries, boundaries[1:]):
+        partitions.append({search_param: [f'ge{low}', f'lt{high}']})
+    partitions.append({search_param: f'ge{boundaries[-1]}'})
+    return partitions
+
+
+def run_concurrently(tasks, max_workers=DEFAULT_WORKERS, ordered=True):
+    """
+    Runs callables on a thread pool with at most 2 * max_workers in flight and yields their results,
+    either in task order or as they complete.
+    """
+    tasks = iter(tasks)
+    max_in_flight = 2 * max_workers
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(task) for task in islice(tasks, max_in_flight))
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pending.remove(future)
+            for future in done:
+                next_task = next(tasks, None)
+                if next_task is not None:
+                    pending.append(executor.submit(next_task))
+                yield future.result()
+
+
+def put_page(outbox, item, stop):
+    """
+    Puts an item on a bounded queue, giving up once stop is set (the consumer went away).
+    """
+    while not stop.is_set():
+        try:
+            outbox.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def fetch_partition(resource_type, params, count, base_url, elements, summary, outbox, stop):
+    """
+    Pages through one partition, putting each Bundle on outbox as it arrives, then (_PARTITION_END, params,
+    complete). complete is False when a page failed before the last one.
+    """
+    complete = False
+    try:
+        last_bundle = None
+        for bundle in iter_pages(resource_type, params, count, prefetch=False, base_url=base_url,
+                                 elements=elements, summary=summary):
+            last_bundle = bundle
+            if not put_page(outbox, bundle, stop):
+                return
+        complete = last_bundle is not None and get_next_link(last_bundle) is None
+    except Exception as e:
+        print(f"Partition {params} failed: {e}")
+    finally:
+        put_page(outbox, (_PARTITION_END, params, complete), stop)
+
+
+def iter_partition_pages(resource_type, partitions, params, count, max_workers, ordered, base_url, elements, summary):
+    """
+    Streams the pages of every partition, one worker per partition. With ordered the partitions are yielded
+    one after another and each worker holds at most PARTITION_QUEUE_SIZE pages ahead of the consumer;
+    otherwise pages are yielded as they arrive. Only the queued pages are in memory, never a whole partition.
+    """
+    stop = threading.Event()
+    shared = queue.Queue(maxsize=PARTITION_QUEUE_SIZE * max_workers)
+    outboxes = [queue.Queue(maxsize=PARTITION_QUEUE_SIZE) if ordered else shared for _ in partitions]
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    failed = []
+    try:
+        for partition, outbox in zip(partitions, outboxes):
+            executor.submit(fetch_partition, resource_type, {**params, **partition}, count, base_url, elements,
+                            summary, outbox, stop)
+        inboxes = [(outbox, 1) for outbox in outboxes] if ordered else [(shared, len(partitions))]
+        for inbox, expected in inboxes:
+            while expected:
+                item = inbox.get()
+                if isinstance(item, tuple) and item[0] is _PARTITION_END:
+                    expected -= 1
+                    if not item[2]:
+                        failed.append(item[1])
+                    continue
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+    if failed:
+        raise IncompleteSearchError(resource_type, failed)
+
+
+def iter_pages_parallel(resource_type, params=None, count=DEFAULT_PAGE_SIZE, max_workers=DEFAULT_WORKERS,
+                        ordered=True, partitions=None, base_url=BASE_URL, elements=None, summary=None):
+    """
+    Fetches the pages of a full-table search concurrently. By default the total is read with _summary=count
+    and the table is split into _offset/_count windows; with partitions (see range_partitions) each disjoint
+    range is paged through on its own worker instead. ordered=False yields pages as soon as they arrive.
+    Falls back to sequential paging when the server does not report a total. Raises IncompleteSearchError,
+    after yielding every page that could be fetched, when a window or partition failed or fewer matches than
+    the total arrived, and as soon as a window overlaps another one.
+    """
+    params = dict(params or {})
+    if partitions is not None:
+        yield from iter_partition_pages(resource_type, list(partitions), params, count, max_workers, ordered,
+                                        base_url, elements, summary)
+        return
+    total = get_total(resource_type, params, base_url)
+    if total is None:
+        yield from iter_pages(resource_type, params, count, base_url=base_url, elements=elements, summary=summary,
+                              strict=True)
+        return
+    url = f'{base_url}/{resource_type}'
+    # A stable order keeps the windows from shifting against each other
+    page_params = {'_sort': '_id', **projection_params(params, elements, summary)}
+    tasks = (
+        lambda offset=offset: (offset, fetch_bundle(url, {**page_params, '_offset': offset, '_count': count},
+                                                    elements, summary))
+        for offset in range(0, total, count)
+    )
+    failed_offsets = []
+    # IDs of the matches seen so far: a window that repeats one overlaps another (the server ignores _offset or
+    # the data moved), and fewer IDs than the total means a window skipped some
+    seen_ids = set()
+    for offset, bundle in run_concurrently(tasks, max_workers, ordered):
+        if bundle is None:
+            failed_offsets.append(offset)
+            continue
+        ids = [
+            entry['resource'].get('id') for entry in bundle.get('entry', [])
+            if 'resource' in entry and entry.get('search', {}).get('mode', 'match') == 'match'
+        ]
+        if not seen_ids.isdisjoint(ids) or len(set(ids)) != len(ids):
+            raise IncompleteSearchError(resource_type, [f"_offset={offset} overlaps another window"])
+        seen_ids.update(ids)
+        yield bundle
+    if failed_offsets:
+        raise IncompleteSearchError(resource_type, [f"_offset={offset}" for offset in sorted(failed_offsets)])
+    if len(seen_ids) < total:
+        raise IncompleteSearchError(resource_type, [f"{total - len(seen_ids)} of {total} matches missing"])
+
+
+def iter_resources_parallel(resource_type, params=None, count=DEFAULT_PAGE_SIZE, max_workers=DEFAULT_WORKERS,
+                            ordered=True, partitions=None, base_url=BASE_URL, elements=None, summary=None):
+    for bundle in iter_pages_parallel(resource_type, params, count, max_workers, ordered, partitions, base_url,
+                                      elements, summary):
+        for entry in bundle.get('entry', []):
+            yield entry['resource']
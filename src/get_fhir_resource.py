@@ -1,59 +1,34 @@
-import json
-import requests
+from src import token_provider
+from src.fhir_search import iter_resources
 from pprint import pprint
-from pathlib import Path
-from src.registration import data_dir
 
 BASE_URL = "https://in-info-web20.luddy.indianapolis.iu.edu/apis/default/fhir"
 
 
-def get_access_token_from_file():
-    file_path = Path(data_dir / "access_token.json")
-    if not file_path.exists():
-        print("Error: access_token.json file not found.")
-        return None
-    try:
-        with open(file_path, 'r') as json_file:
-            json_data = json.load(json_file)
-            access_token = json_data.get("access_token")
-        return access_token
-    except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error reading access token from file: {e}")
-        return None
-
-
-def get_headers():
-    access_token = get_access_token_from_file()
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    return headers
-
-
 def get_fhir_resource(resource_name):
     url = f'{BASE_URL}/{resource_name}'
-    response = requests.get(url=url, headers=get_headers())
+    response = token_provider.get(url=url)
     print(response.url)
     pprint(response.json())
 
 
 def get_fhir_patient(resource_id):
     url = f'{BASE_URL}/Patient/{resource_id}'
-    response = requests.get(url=url, headers=get_headers())
+    response = token_provider.get(url=url)
     print(response.url)
     pprint(response.json())
 
 
 def search_patient_by_name(name_string):
     url = f'{BASE_URL}/Patient?name={name_string}'
-    response = requests.get(url=url, headers=get_headers())
+    response = token_provider.get(url=url)
     print(response.url)
     pprint(response.json())
 
 
 def search_patient_by_name_gender(name_string, gender):
     url = f'{BASE_URL}/Patient?name={name_string}&gender={gender}'
-    response = requests.get(url=url, headers=get_headers())
+    response = token_provider.get(url=url)
     print(response.url)
     data = response.json()
     if 'entry' in data:
@@ -69,14 +44,14 @@ def search_patient_by_name_gender(name_string, gender):
 
 def search_patient_where_address_contains(address_string):
     url = f'{BASE_URL}/Patient?address:contains={address_string}'
-    response = requests.get(url=url, headers=get_headers())
+    response = token_provider.get(url=url)
     print(response.url)
     pprint(response.json())
 
 
 def get_patient_name_where_address_contains(address_string):
     url = f'{BASE_URL}/Patient?address:contains={address_string}'
-    response = requests.get(url=url, headers=get_headers())
+    response = token_provider.get(url=url)
     print(response.url)
     data = response.json()
     entry = data['entry']
@@ -92,7 +67,7 @@ def get_patient_name_where_address_contains(address_string):
 
 def get_patient_where_dob_equals(birth_date):
     url = f'{BASE_URL}/Patient?birthdate={birth_date}'
-    response = requests.get(url=url, headers=get_headers())
+    response = token_provider.get(url=url)
     print(response.url)
     data = response.json()
     entry = data['entry']
@@ -107,23 +82,20 @@ def get_patient_where_dob_equals(birth_date):
 
 
 def get_patient_gender_where_dob_greater_than(birth_date):
-    url = f'{BASE_URL}/Patient?birthdate=gt{birth_date}'
-    response = requests.get(url=url, headers=get_headers())
-    print(response.url)
-    data = response.json()
-    if 'entry' in data:
-        print(f"Number of entries: {len(data['entry'])}")
-        entry = data['entry']
-        for item in entry:
-            resource_id = item['resource']['id']
-            print(f"{resource_id} - {item['resource']['gender']} - {item['resource']['birthDate']}")
+    # Only gender and birthDate are downloaded
+    patients = list(iter_resources('Patient', {'birthdate': f'gt{birth_date}'}, elements=('gender', 'birthDate')))
+    if patients:
+        print(f"Number of entries: {len(patients)}")
+        for patient in patients:
+            resource_id = patient['id']
+            print(f"{resource_id} - {patient.get('gender')} - {patient.get('birthDate')}")
     else:
         print('No results found')
 
 
 def search_condition(patient_resource_id):
     url = f'{BASE_URL}/Condition?patient={patient_resource_id}'
-    response = requests.get(url=url, headers=get_headers())
+    response = token_provider.get(url=url)
     print(response.url)
     data = response.json()
     if 'entry' in data:
@@ -145,7 +117,7 @@ def search_condition(patient_resource_id):
 
 def search_observation(patient_resource_id):
     url = f'{BASE_URL}/Observation?patient={patient_resource_id}&code=http://loinc.org|85354-9'
-    response = requests.get(url=url, headers=get_headers())
+    response = token_provider.get(url=url)
     print(response.url)
     if response.status_code == 200:
         data = response.json()
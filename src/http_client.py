@@ -0,0 +1,96 @@
+import threading
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from src import resilience
+
+# Connection pool and timeout settings shared by every OpenEMR, Primary Care, Hermes and OAuth call
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 20
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 180
+DEFAULT_HEADERS = {
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive",
+}
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_base_url(url):
+    """
+    Returns the scheme://host:port part of a URL, which is the key of its pooled session.
+    """
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def configure(pool_connections=None, pool_maxsize=None, connect_timeout=None, read_timeout=None):
+    """
+    Changes the pool size and timeouts. Sessions that are already open are closed so the new
+    settings apply to the next request.
+    """
+    global POOL_CONNECTIONS, POOL_MAXSIZE, CONNECT_TIMEOUT, READ_TIMEOUT
+    if pool_connections is not None:
+        POOL_CONNECTIONS = pool_connections
+    if pool_maxsize is not None:
+        POOL_MAXSIZE = pool_maxsize
+    if connect_timeout is not None:
+        CONNECT_TIMEOUT = connect_timeout
+    if read_timeout is not None:
+        READ_TIMEOUT = read_timeout
+    close_sessions()
+
+
+def create_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(DEFAULT_HEADERS)
+    return session
+
+
+def get_session(url):
+    """
+    Returns the keep-alive session for the host of the given URL, creating it on first use.
+    """
+    base_url = get_base_url(url)
+    session = _sessions.get(base_url)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(base_url)
+            if session is None:
+                session = create_session()
+                _sessions[base_url] = session
+    return session
+
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def request(method, url, max_retries=None, **kwargs):
+    """
+    Sends a request through the pooled session of the target host. Accepts the same keyword
+    arguments as requests.request and applies the default timeouts when none is given. The request
+    is paced and retried by the host policy in resilience; max_retries overrides its retry count.
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    session = get_session(url)
+    return resilience.send_with_retries(
+        method, get_base_url(url), lambda: session.request(method=method, url=url, **kwargs), max_retries
+    )
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
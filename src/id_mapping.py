@@ -0,0 +1,143 @@
+import sqlite3
+import threading
+import time
+from src.registration import data_dir
+
+# Source (OpenEMR) ID to target (Primary Care) ID mapping, keyed by resource type. Rows live in an indexed
+# SQLite table and every looked-up or stored pair is kept in an in-memory dict, so resolving a reference
+# for a resource that was already seen costs one dictionary lookup.
+MAPPING_PATH = data_dir / "id_mapping.sqlite"
+# SQLite limits the number of host parameters in one statement
+LOOKUP_BATCH_SIZE = 500
+
+_mapping_cache = {}
+_mapping_lock = threading.Lock()
+_connection = None
+
+
+def get_connection():
+    global _connection
+    if _connection is None:
+        MAPPING_PATH.parent.mkdir(parents=True, exist_ok=True)
+        _connection = sqlite3.connect(str(MAPPING_PATH), check_same_thread=False)
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS id_mapping ("
+            "resource_type TEXT NOT NULL, source_id TEXT NOT NULL, target_id TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (resource_type, source_id))"
+        )
+        _connection.execute(
+            "CREATE INDEX IF NOT EXISTS id_mapping_created ON id_mapping (resource_type, created_at)"
+        )
+        _connection.commit()
+    return _connection
+
+
+def get_target_ids(resource_type, source_ids):
+    """
+    Bulk lookup. Returns a dict of source ID to target ID for the source IDs that have a mapping; IDs not
+    in the in-memory cache are read from SQLite in batches of LOOKUP_BATCH_SIZE.
+    """
+    found = {}
+    missing = []
+    with _mapping_lock:
+        for source_id in dict.fromkeys(str(source_id) for source_id in source_ids):
+            target_id = _mapping_cache.get((resource_type, source_id))
+            if target_id is None:
+                missing.append(source_id)
+            else:
+                found[source_id] = target_id
+        connection = get_connection()
+        for start in range(0, len(missing), LOOKUP_BATCH_SIZE):
+            batch = missing[start:start + LOOKUP_BATCH_SIZE]
+            rows = connection.execute(
+                f"SELECT source_id, target_id FROM id_mapping WHERE resource_type = ? "
+                f"AND source_id IN ({','.join('?' * len(batch))})",
+                (resource_type, *batch)
+            ).fetchall()
+            for source_id, target_id in rows:
+                _mapping_cache[(resource_type, source_id)] = target_id
+                found[source_id] = target_id
+    return found
+
+
+def get_target_id(resource_type, source_id):
+    """
+    Returns the target ID mapped to a source ID, or None if the resource has not been loaded yet.
+    """
+    return get_target_ids(resource_type, [source_id]).get(str(source_id))
+
+
+def set_target_ids(resource_type, pairs):
+    """
+    Bulk insert of (source ID, target ID) pairs in one transaction. An existing mapping is replaced.
+    """
+    created_at = time.time()
+    rows = [(resource_type, str(source_id), str(target_id), created_at) for source_id, target_id in pairs]
+    with _mapping_lock:
+        connection = get_connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO id_mapping (resource_type, source_id, target_id, created_at) "
+                "VALUES (?, ?, ?, ?)",
+                rows
+            )
+        for _, source_id, target_id, _ in rows:
+            _mapping_cache[(resource_type, source_id)] = target_id
+
+
+def set_target_id(resource_type, source_id, target_id):
+    set_target_ids(resource_type, [(source_id, target_id)])
+
+
+def get_latest_target_id(resource_type):
+    """
+    Returns the target ID of the most recently mapped resource of a type, or None if there is none.
+    """
+    with _mapping_lock:
+        row = get_connection().execute(
+            "SELECT target_id FROM id_mapping WHERE resource_type = ? ORDER BY created_at DESC LIMIT 1",
+            (resource_type,)
+        ).fetchone()
+    return row[0] if row else None
+
+
+def get_source_ids(resource_type):
+    """
+    Returns the source IDs of every mapped resource of a type, i.e. everything loaded so far.
+    """
+    with _mapping_lock:
+        rows = get_connection().execute(
+            "SELECT source_id FROM id_mapping WHERE resource_type = ? ORDER BY source_id", (resource_type,)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def get_reference(reference):
+    """
+    Translates a source reference such as 'Patient/985ac7e3-...' into the matching target reference, or
+    returns None if the referenced resource has not been loaded.
+    """
+    resource_type, _, source_id = reference.partition('/')
+    target_id = get_target_id(resource_type, source_id)
+    return f"{resource_type}/{target_id}" if target_id is not None else None
+
+
+def get_references(references):
+    """
+    Bulk version of get_reference. Returns a dict of source reference to target reference for the
+    references that could be resolved, with one lookup per resource type.
+    """
+    by_type = {}
+    for reference in references:
+        resource_type, _, source_id = reference.partition('/')
+        by_type.setdefault(resource_type, []).append(source_id)
+    resolved = {}
+    for resource_type, source_ids in by_type.items():
+        for source_id, target_id in get_target_ids(resource_type, source_ids).items():
+            resolved[f"{resource_type}/{source_id}"] = f"{resource_type}/{target_id}"
+    return resolved
+
+
+def clear_cache():
+    with _mapping_lock:
+        _mapping_cache.clear()
@@ -0,0 +1,98 @@
+from src.fhir_search import (DEFAULT_PAGE_SIZE, DEFAULT_WORKERS, IncompleteSearchError, chunked, iter_pages,
+                              run_concurrently)
+
+# Patient-graph extraction. One search per group of patients,
+#   Patient?_id=a,b,c&_revinclude=Condition:patient&_revinclude=Observation:patient&_revinclude=Procedure:patient
+# returns the Patients together with every resource that references them. The combined Bundle is split
+# back into one graph per patient through an index of 'Patient/<id>' references.
+REVINCLUDES = ('Condition:patient', 'Observation:patient', 'Procedure:patient')
+IDS_PER_SEARCH = 50
+# Reference elements pointing at the patient, in the order they are checked
+PATIENT_REFERENCE_ELEMENTS = ('subject', 'patient')
+
+
+def graph_key(resource_type):
+    """
+    Key under which a patient graph keeps the resources of a type: 'Condition' -> 'conditions'.
+    """
+    return resource_type.lower() + 's'
+
+
+def new_graph(patient, revincludes=REVINCLUDES):
+    graph = {'patient': patient}
+    for revinclude in revincludes:
+        graph[graph_key(revinclude.split(':')[0])] = []
+    return graph
+
+
+def relative_reference(reference):
+    """
+    Reduces an absolute reference ('https://.../fhir/Patient/123') to its 'Patient/123' form.
+    """
+    return '/'.join(reference.split('/_history/')[0].rstrip('/').split('/')[-2:])
+
+
+def get_patient_reference(resource):
+    for element in PATIENT_REFERENCE_ELEMENTS:
+        reference = resource.get(element, {}).get('reference')
+        if reference:
+            return relative_reference(reference)
+    return None
+
+
+def split_graphs(entries, revincludes=REVINCLUDES):
+    """
+    Splits the entries of a _revinclude search into a dict of patient ID to graph. Included resources whose
+    patient is not among the matches are dropped.
+    """
+    resources = [entry['resource'] for entry in entries]
+    graphs = {
+        f"Patient/{resource['id']}": new_graph(resource, revincludes)
+        for resource in resources if resource['resourceType'] == 'Patient'
+    }
+    for resource in resources:
+        if resource['resourceType'] == 'Patient':
+            continue
+        graph = graphs.get(get_patient_reference(resource))
+        if graph is not None:
+            graph.setdefault(graph_key(resource['resourceType']), []).append(resource)
+    return {reference.split('/', 1)[1]: graph for reference, graph in graphs.items()}
+
+
+def search_patient_graphs(patient_ids, revincludes=REVINCLUDES, count=DEFAULT_PAGE_SIZE):
+    """
+    Runs one _revinclude search for the given patient IDs, following paging, and returns their graphs.
+    Raises IncompleteSearchError if a page could not be fetched, since the graphs would miss resources.
+    """
+    params = {'_id': ','.join(patient_ids), '_revinclude': list(revincludes)}
+    entries = []
+    for bundle in iter_pages('Patient', params, count, prefetch=False, strict=True):
+        entries.extend(bundle.get('entry', []))
+    return split_graphs(entries, revincludes)
+
+
+def try_search_patient_graphs(patient_ids, revincludes=REVINCLUDES):
+    """
+    search_patient_graphs for the concurrent searches: an incomplete search is reported with the patient IDs
+    it covered and yields no graphs, so none of those patients is migrated with missing resources.
+    """
+    try:
+        return search_patient_graphs(patient_ids, revincludes)
+    except IncompleteSearchError as e:
+        print(f"Error: skipping patients {', '.join(patient_ids)}: {e}")
+        return {}
+
+
+def iter_patient_graphs(patient_ids, revincludes=REVINCLUDES, ids_per_search=IDS_PER_SEARCH,
+                        max_workers=DEFAULT_WORKERS):
+    """
+    Yields the graph of every patient, searching IDS_PER_SEARCH patients per request with the searches
+    running concurrently. Each graph holds 'patient' and a list per included type ('conditions',
+    'observations', 'procedures'). Patients of a group whose search was incomplete are reported and skipped.
+    """
+    tasks = (
+        lambda group=group: try_search_patient_graphs(group, revincludes)
+        for group in chunked(patient_ids, ids_per_search)
+    )
+    for graphs in run_concurrently(tasks, max_workers, ordered=False):
+        yield from graphs.values()
@@ -0,0 +1,99 @@
+from src import fhir_loader, patient_graph, token_provider
+from src.fhir_search import BASE_URL, iter_resources
+from src.pipeline import DEFAULT_QUEUE_SIZE, Stage, run_pipeline
+from src.snomed_parent import constraint_child, constraint_parent, expression_constraint
+from src.task_1 import get_condition_code, transform_condition, transform_patient
+from src.task_2 import transform_child_condition
+
+# Patient migration as a pipeline: extract (OpenEMR Patient and Conditions) -> resolve (SNOMED parent and
+# child of every condition code through the local index or Hermes) -> transform (task_1/task_2 builders)
+# -> load (one transaction Bundle per patient into Primary Care).
+EXTRACT_WORKERS = 8
+RESOLVE_WORKERS = 8
+TRANSFORM_WORKERS = 4
+LOAD_WORKERS = 4
+
+
+def extract_patient(patient):
+    """
+    Takes an OpenEMR Patient resource or ID and returns a record with the Patient and its Conditions.
+    """
+    if isinstance(patient, str):
+        response = token_provider.get(url=f'{BASE_URL}/Patient/{patient}')
+        if response.status_code != 200:
+            print(f"Failed to retrieve Patient/{patient}. Status code: {response.status_code}")
+            return None
+        patient = response.json()
+    # strict: a patient whose Condition search stops early fails the stage instead of loading part of them
+    conditions = list(iter_resources('Condition', {'patient': patient['id']}, prefetch=False, strict=True))
+    return {'patient': patient, 'conditions': conditions}
+
+
+def resolve_snomed(record):
+    codes = [code for code in dict.fromkeys(get_condition_code(condition) for condition in record['conditions']) if code]
+    record['parents'] = {code: expression_constraint(constraint_parent(code)) for code in codes}
+    record['children'] = {code: expression_constraint(constraint_child(code)) for code in codes}
+    return record
+
+
+def transform_record(record):
+    """
+    Builds the Primary Care resources of one record as (resource, source_reference) pairs.
+    """
+    patient = transform_patient(record['patient'])
+    # Conditions reference the Patient by its fullUrl within the same transaction
+    patient_url = patient['identifier'][0]['value']
+    resources = [(patient, f"Patient/{record['patient']['id']}")]
+    for condition in record['conditions']:
+        code = get_condition_code(condition)
+        parent_concept = record['parents'].get(code)
+        if parent_concept is not None:
+            resources.append((transform_condition(condition, patient_url, parent_concept), f"Condition/{condition['id']}"))
+        else:
+            print(f"Skipping Condition/{condition['id']}: no SNOMED parent for code {code}")
+        child_concept = record['children'].get(code)
+        if child_concept is not None:
+            resources.append((transform_child_condition(condition, patient_url, child_concept), None))
+        else:
+            print(f"Skipping child of Condition/{condition['id']}: no SNOMED child for code {code}")
+    return resources
+
+
+def load_resources(resources):
+    loaded, failed = fhir_loader.load_bundles(resources, 'transaction', bundle_size=len(resources))
+    return loaded if failed == 0 else None
+
+
+def run_patient_pipeline(patients=None, queue_size=DEFAULT_QUEUE_SIZE, extract_workers=EXTRACT_WORKERS,
+                         resolve_workers=RESOLVE_WORKERS, transform_workers=TRANSFORM_WORKERS,
+                         load_workers=LOAD_WORKERS, use_revinclude=False):
+    """
+    Migrates the given OpenEMR patients (resources or IDs; every patient on the server by default) with their
+    parent and child conditions. With use_revinclude the extract stage is replaced by patient_graph searches,
+    which fetch the Patients and Conditions of IDS_PER_SEARCH patients per request. Returns the per-stage
+    counts from pipeline.run_pipeline.
+    """
+    if patients is None:
+        patients = iter_resources('Patient')
+    if use_revinclude:
+        patient_ids = (patient if isinstance(patient, str) else patient['id'] for patient in patients)
+        patients = patient_graph.iter_patient_graphs(patient_ids, revincludes=('Condition:patient',),
+                                                     max_workers=extract_workers)
+        stages = []
+    else:
+        stages = [Stage('extract', extract_patient, extract_workers)]
+    stages += [
+        Stage('resolve', resolve_snomed, resolve_workers),
+        Stage('transform', transform_record, transform_workers),
+        Stage('load', load_resources, load_workers),
+    ]
+    stats = run_pipeline(patients, stages, queue_size)
+    load_stats = stats['load']
+    print(f"Migrated {load_stats['processed'] - load_stats['dropped']} patient(s) in {stats['elapsed']:.1f}s")
+    for stage in stages:
+        print(f"{stage.name}: {stats[stage.name]}")
+    return stats
+
+
+if __name__ == '__main__':
+    run_patient_pipeline()
@@ -0,0 +1,88 @@
+import queue
+import threading
+import time
+
+# Multi-stage pipeline runner. Every stage has its own pool of worker threads and reads from a bounded queue
+# filled by the previous stage, so the network waits of different stages overlap while a full queue makes
+# the upstream stage wait (backpressure). At most queue_size items sit between two stages, which bounds
+# peak memory regardless of how many items the source produces.
+DEFAULT_QUEUE_SIZE = 32
+
+_STOP = object()
+
+
+class Stage:
+    """
+    One pipeline step. function takes an item and returns the item for the next stage, or None to drop it.
+    With expand=True it returns an iterable and each of its elements goes to the next stage separately.
+    """
+
+    def __init__(self, name, function, workers=1, expand=False):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.expand = expand
+
+
+def run_stage(stage, inbox, outbox, stats, lock, remaining, next_workers):
+    while True:
+        item = inbox.get()
+        if item is _STOP:
+            break
+        try:
+            result = stage.function(item)
+            # A lazy iterable of an expand stage is consumed here, so its errors are counted like any other
+            if stage.expand and result is not None:
+                result = list(result)
+        except Exception as e:
+            print(f"Stage {stage.name} failed: {e}")
+            with lock:
+                stats[stage.name]["errors"] += 1
+            continue
+        with lock:
+            stats[stage.name]["processed"] += 1
+            if result is None:
+                stats[stage.name]["dropped"] += 1
+        if result is None:
+            continue
+        if outbox is not None:
+            for output in (result if stage.expand else [result]):
+                outbox.put(output)
+    # The last worker of a stage to finish tells every worker of the next stage to stop
+    with lock:
+        remaining[stage.name] -= 1
+        last = remaining[stage.name] == 0
+    if last and outbox is not None:
+        for _ in range(next_workers):
+            outbox.put(_STOP)
+
+
+def run_pipeline(items, stages, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    Feeds items through the stages and waits until every item has left the last stage. Returns a dict of
+    stage name to processed/dropped/error counts, plus the elapsed time.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    lock = threading.Lock()
+    stats = {stage.name: {"processed": 0, "dropped": 0, "errors": 0} for stage in stages}
+    remaining = {stage.name: stage.workers for stage in stages}
+    threads = []
+    for number, stage in enumerate(stages):
+        outbox = queues[number + 1] if number + 1 < len(stages) else None
+        next_workers = stages[number + 1].workers if outbox is not None else 0
+        for worker in range(stage.workers):
+            thread = threading.Thread(
+                target=run_stage, name=f"{stage.name}-{worker}", daemon=True,
+                args=(stage, queues[number], outbox, stats, lock, remaining, next_workers),
+            )
+            thread.start()
+            threads.append(thread)
+    started = time.monotonic()
+    for item in items:
+        queues[0].put(item)
+    for _ in range(stages[0].workers):
+        queues[0].put(_STOP)
+    for thread in threads:
+        thread.join()
+    stats["elapsed"] = time.monotonic() - started
+    return stats
@@ -1,6 +1,6 @@
 from pathlib import Path
 import json
-import requests
+from src import http_client
 from src.registration import get_client_id_from_file, data_dir, TOKEN_URL
 
 
@@ -43,16 +43,18 @@ def get_headers():
 
 
 def renew_access_token():
-    response = requests.request(method="POST", url=TOKEN_URL, data=get_payload(), headers=get_headers())
+    response = http_client.request(method="POST", url=TOKEN_URL, data=get_payload(), headers=get_headers())
     if response.status_code == 200:
         access_token_path = Path(data_dir / "access_token.json")
         access_token_path.touch(exist_ok=True)
         with open(access_token_path, 'w') as f:
             json.dump(response.json(), f, ensure_ascii=False, indent=4)
         print(f"access_token:{response.json().get('access_token')}")
+        return response.json()
     else:
         print(f"Error when trying to generate access token: {response.status_code}")
         print(f"Error: {response.json()}")
+        return None
 
 
 if __name__ == '__main__':
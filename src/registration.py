@@ -1,5 +1,5 @@
 import random
-import requests
+from src import http_client
 import json
 from pathlib import Path
 
@@ -30,7 +30,7 @@ def get_client_registration_details():
         'content-type': 'application/json'
     }
 
-    response = requests.request(method="POST", url=URL, headers=headers, data=payload)
+    response = http_client.request(method="POST", url=URL, headers=headers, data=payload)
     data = response.json()
 
     client_id = data['client_id']
@@ -0,0 +1,172 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import requests
+
+# Retries and rate limiting applied to every request sent through http_client. Each host has a token bucket
+# that paces requests to a steady rate, and a retry policy: failed attempts are retried with exponential
+# backoff and full jitter, and a Retry-After from a 429/503 holds back every request to that host, not only
+# the one that was throttled.
+OPENEMR_HOST = "https://in-info-web20.luddy.indianapolis.iu.edu"
+PRIMARY_CARE_HOST = "http://137.184.71.65:8080"
+HERMES_HOST = "http://159.65.173.51:8080"
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# A POST is only retried when the server certainly did not process it
+POST_RETRY_STATUS_CODES = (429, 503)
+THROTTLE_STATUS_CODES = (429, 503)
+IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+MAX_RETRY_AFTER = 300
+
+DEFAULT_POLICY = {
+    "rate": 20.0,         # requests per second
+    "burst": 40,          # bucket capacity
+    "max_retries": 5,
+    "backoff_base": 0.5,  # seconds
+    "backoff_cap": 60.0,
+}
+HOST_POLICIES = {
+    OPENEMR_HOST: {**DEFAULT_POLICY, "rate": 10.0, "burst": 20},
+    PRIMARY_CARE_HOST: {**DEFAULT_POLICY, "rate": 50.0, "burst": 100},
+    HERMES_HOST: {**DEFAULT_POLICY, "rate": 50.0, "burst": 50},
+}
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes one token, sleeping until it is available. Tokens are reserved in arrival order, so waiting
+        threads are released one every 1/rate seconds.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def hold(self, seconds):
+        """
+        Empties the bucket so that no request goes out for the next seconds.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+def get_policy(base_url):
+    return HOST_POLICIES.get(base_url, DEFAULT_POLICY)
+
+
+def configure_host(base_url, **settings):
+    """
+    Changes the rate, burst, max_retries, backoff_base or backoff_cap of one host, e.g.
+    configure_host(PRIMARY_CARE_HOST, rate=5, max_retries=8).
+    """
+    unknown = set(settings) - set(DEFAULT_POLICY)
+    if unknown:
+        raise ValueError(f"Unknown policy setting(s): {', '.join(sorted(unknown))}")
+    with _buckets_lock:
+        HOST_POLICIES[base_url] = {**get_policy(base_url), **settings}
+        _buckets.pop(base_url, None)
+
+
+def get_bucket(base_url):
+    bucket = _buckets.get(base_url)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.get(base_url)
+            if bucket is None:
+                policy = get_policy(base_url)
+                bucket = TokenBucket(policy["rate"], policy["burst"])
+                _buckets[base_url] = bucket
+    return bucket
+
+
+def backoff_delay(attempt, policy):
+    """
+    Full jitter: a random delay between 0 and backoff_base * 2 ** attempt, capped at backoff_cap.
+    """
+    return random.uniform(0, min(policy["backoff_cap"], policy["backoff_base"] * 2 ** attempt))
+
+
+def get_retry_after(response):
+    """
+    Returns the Retry-After header in seconds (either delay-seconds or an HTTP date), or None if absent.
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER)
+
+
+def is_retryable_status(method, status_code):
+    if method.upper() in IDEMPOTENT_METHODS:
+        return status_code in RETRY_STATUS_CODES
+    return status_code in POST_RETRY_STATUS_CODES
+
+
+def is_retryable_error(method, error):
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    return method.upper() in IDEMPOTENT_METHODS and isinstance(
+        error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+
+
+def send_with_retries(method, base_url, send, max_retries=None):
+    """
+    Calls send() (which performs one HTTP attempt) after taking a token from the host bucket, and retries
+    throttled, failed or timed-out attempts as the host policy allows. Returns the last response; a
+    request error is raised once the retries are used up. The Retry-After of a 429/503 holds back the host
+    whether or not retries remain.
+    """
+    policy = get_policy(base_url)
+    bucket = get_bucket(base_url)
+    max_retries = policy["max_retries"] if max_retries is None else max_retries
+    attempt = 0
+    while True:
+        bucket.acquire()
+        try:
+            response = send()
+        except requests.exceptions.RequestException as e:
+            if attempt >= max_retries or not is_retryable_error(method, e):
+                raise
+            delay = backoff_delay(attempt, policy)
+            print(f"{method} to {base_url} failed ({e}); retrying in {delay:.1f}s")
+        else:
+            retry_after = get_retry_after(response)
+            retrying = attempt < max_retries and is_retryable_status(method, response.status_code)
+            # A throttled response holds back the host even when it is not retried here, so a caller that
+            # resends it on its own (adaptive_loader) waits for the Retry-After in bucket.acquire()
+            if retry_after is not None and (retrying or response.status_code in THROTTLE_STATUS_CODES):
+                bucket.hold(retry_after)
+            if not retrying:
+                return response
+            response.close()
+            delay = 0 if retry_after is not None else backoff_delay(attempt, policy)
+            print(f"{method} to {base_url} returned {response.status_code}; retrying in "
+                  f"{retry_after if retry_after is not None else delay:.1f}s")
+        time.sleep(delay)
+        attempt += 1
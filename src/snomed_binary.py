@@ -0,0 +1,88 @@
+import json
+import mmap
+import struct
+import numpy as np
+
+# Single-file binary container for the compiled SNOMED snapshot. Layout:
+#   8-byte magic, uint32 format version, uint32 header length, JSON header, then 8-byte aligned sections.
+# The header maps each section name to [dtype, offset, count]. Files are opened with mmap and every array
+# is a zero-copy view of the mapping, so worker processes share the same pages through the OS page cache.
+MAGIC = b'SNOMEDIX'
+FORMAT_VERSION = 1
+PREFIX = struct.Struct('<8sII')
+ALIGNMENT = 8
+
+
+class StringTable:
+    """
+    Read-only list of strings stored as one UTF-8 blob plus an int64 offset array.
+    """
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+
+def encode_strings(strings):
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+
+def write_snapshot(path, arrays, strings, metadata=None):
+    """
+    Writes named numpy arrays and named string lists to a versioned snapshot file.
+    """
+    sections = dict(arrays)
+    for name, values in strings.items():
+        sections[f'{name}.offsets'], sections[f'{name}.blob'] = encode_strings(values)
+    layout = {}
+    offset = 0
+    for name, array in sections.items():
+        array = np.ascontiguousarray(array)
+        sections[name] = array
+        layout[name] = [array.dtype.str, offset, len(array)]
+        offset += array.nbytes
+        offset += -offset % ALIGNMENT
+    header = json.dumps({'sections': layout, 'strings': list(strings), 'metadata': metadata or {}}).encode('utf-8')
+    header += b' ' * (-(PREFIX.size + len(header)) % ALIGNMENT)
+    data_start = PREFIX.size + len(header)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(PREFIX.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        for name, array in sections.items():
+            f.seek(data_start + layout[name][1])
+            f.write(array.tobytes())
+
+
+def open_snapshot(path):
+    """
+    Maps a snapshot file and returns (arrays, strings, metadata). Raises ValueError if the file is not a
+    snapshot or was written by another format version.
+    """
+    with open(path, 'rb') as f:
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, header_length = PREFIX.unpack_from(mapping, 0)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a SNOMED snapshot file")
+    if version != FORMAT_VERSION:
+        raise ValueError(f"{path} has format version {version}, expected {FORMAT_VERSION}")
+    header = json.loads(mapping[PREFIX.size:PREFIX.size + header_length].decode('utf-8'))
+    data_start = PREFIX.size + header_length
+    arrays = {
+        name: np.frombuffer(mapping, dtype=np.dtype(dtype), count=count, offset=data_start + offset)
+        for name, (dtype, offset, count) in header['sections'].items()
+    }
+    strings = {
+        name: StringTable(arrays.pop(f'{name}.offsets'), arrays.pop(f'{name}.blob'))
+        for name in header['strings']
+    }
+    return arrays, strings, header['metadata']
@@ -0,0 +1,132 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from src.registration import data_dir
+
+# Two-tier cache for Hermes ECL search results: an in-process LRU in front of an on-disk SQLite table.
+# Entries are tagged with the SNOMED release they were fetched from and expire after CACHE_TTL seconds. The
+# release is detected from Hermes (or the local snapshot) by snomed_parent.configure_cache_release.
+CACHE_PATH = data_dir / "snomed_cache.sqlite"
+MAX_MEMORY_ENTRIES = 4096
+CACHE_TTL = 30 * 24 * 60 * 60
+SNOMED_RELEASE = "default"
+
+_memory_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_connection = None
+_stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+
+def configure(release=None, ttl=None, max_memory_entries=None, cache_path=None):
+    """
+    Changes the SNOMED release tag, TTL, LRU size or database path. Switching release makes every
+    entry fetched from another release a miss.
+    """
+    global SNOMED_RELEASE, CACHE_TTL, MAX_MEMORY_ENTRIES, CACHE_PATH, _connection
+    with _cache_lock:
+        if release is not None:
+            SNOMED_RELEASE = str(release)
+        if ttl is not None:
+            CACHE_TTL = ttl
+        if max_memory_entries is not None:
+            MAX_MEMORY_ENTRIES = max_memory_entries
+        if cache_path is not None:
+            CACHE_PATH = cache_path
+            if _connection is not None:
+                _connection.close()
+                _connection = None
+        _memory_cache.clear()
+
+
+def normalize_constraint(search_string):
+    """
+    Builds the cache key of an ECL expression: |term| annotations are dropped and whitespace collapsed,
+    so '>! 74400008 | Parent |' and '>!74400008' share one entry.
+    """
+    constraint = re.sub(r'\|[^|]*\|', ' ', search_string)
+    constraint = re.sub(r'\s+', ' ', constraint).strip()
+    constraint = re.sub(r'\s*(!=|[:{}(),=])\s*', r'\1', constraint)
+    return re.sub(r'([<>]{1,2}!?)\s+', r'\1', constraint)
+
+
+def get_connection():
+    global _connection
+    if _connection is None:
+        CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        _connection = sqlite3.connect(str(CACHE_PATH), check_same_thread=False)
+        _connection.execute(
+            "CREATE TABLE IF NOT EXISTS ecl_cache ("
+            "constraint_key TEXT NOT NULL, release TEXT NOT NULL, result TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (constraint_key, release))"
+        )
+        _connection.commit()
+    return _connection
+
+
+def remember(key, value):
+    _memory_cache[key] = value
+    _memory_cache.move_to_end(key)
+    while len(_memory_cache) > MAX_MEMORY_ENTRIES:
+        _memory_cache.popitem(last=False)
+
+
+def get_cached(search_string):
+    """
+    Returns the cached Hermes result list for an ECL expression, or None on a miss.
+    """
+    key = normalize_constraint(search_string)
+    with _cache_lock:
+        entry = _memory_cache.get(key)
+        if entry is not None and time.time() - entry[1] < CACHE_TTL:
+            _memory_cache.move_to_end(key)
+            _stats["memory_hits"] += 1
+            return entry[0]
+        row = get_connection().execute(
+            "SELECT result, created_at FROM ecl_cache WHERE constraint_key = ? AND release = ?",
+            (key, SNOMED_RELEASE)
+        ).fetchone()
+        if row is not None and time.time() - row[1] < CACHE_TTL:
+            result = json.loads(row[0])
+            remember(key, (result, row[1]))
+            _stats["disk_hits"] += 1
+            return result
+        _stats["misses"] += 1
+        return None
+
+
+def set_cached(search_string, result):
+    key = normalize_constraint(search_string)
+    created_at = time.time()
+    with _cache_lock:
+        remember(key, (result, created_at))
+        connection = get_connection()
+        connection.execute(
+            "INSERT OR REPLACE INTO ecl_cache (constraint_key, release, result, created_at) VALUES (?, ?, ?, ?)",
+            (key, SNOMED_RELEASE, json.dumps(result), created_at)
+        )
+        connection.commit()
+
+
+def clear_cache():
+    with _cache_lock:
+        _memory_cache.clear()
+        connection = get_connection()
+        connection.execute("DELETE FROM ecl_cache")
+        connection.commit()
+        for name in _stats:
+            _stats[name] = 0
+
+
+def cache_info():
+    """
+    Returns the hit/miss counters and the current size of the in-memory tier.
+    """
+    with _cache_lock:
+        info = dict(_stats)
+        info["hits"] = info["memory_hits"] + info["disk_hits"]
+        info["memory_entries"] = len(_memory_cache)
+        info["release"] = SNOMED_RELEASE
+        return info
@@ -0,0 +1,272 @@
+import threading
+import numpy as np
+from src.registration import data_dir
+from src.snomed_cache import normalize_constraint
+from src.snomed_index import build_csr, get_index
+from src.snomed_index import evaluate_constraint as evaluate_index_constraint
+
+# Precomputed transitive closure of the SNOMED is-a hierarchy using interval labelling.
+# Every concept gets a post-order number from a spanning tree of the DAG, and the set of its
+# descendants-or-self is stored as a short list of disjoint post-order intervals. Subsumption is then
+# a binary search over a handful of intervals and "all descendants" is a slice of the post-order array.
+CLOSURE_PATH = data_dir / "snomed_closure.npz"
+CLOSURE_SECTIONS = ('post', 'order', 'interval_offsets', 'interval_starts', 'interval_ends')
+
+_closure = None
+_closure_loaded = False
+_closure_lock = threading.Lock()
+
+
+class SnomedClosure:
+    def __init__(self, index, post, order, interval_offsets, interval_starts, interval_ends):
+        self.index = index
+        self.post = post
+        self.order = order
+        self.interval_offsets = interval_offsets
+        self.interval_starts = interval_starts
+        self.interval_ends = interval_ends
+
+    def intervals(self, i):
+        start, end = self.interval_offsets[i], self.interval_offsets[i + 1]
+        return self.interval_starts[start:end], self.interval_ends[start:end]
+
+    def contains(self, ancestor_position, positions):
+        """
+        Returns a boolean array telling which of the given concept positions are descendants-or-self of the ancestor.
+        """
+        starts, ends = self.intervals(ancestor_position)
+        labels = self.post[positions]
+        k = np.searchsorted(starts, labels, side='right') - 1
+        return (k >= 0) & (labels <= ends[np.maximum(k, 0)])
+
+    def is_descendant_or_self(self, concept_id, ancestor_id):
+        i = self.index.position(concept_id)
+        j = self.index.position(ancestor_id)
+        if i is None or j is None:
+            return False
+        return bool(self.contains(j, np.array([i]))[0])
+
+    def is_descendant(self, concept_id, ancestor_id):
+        return int(concept_id) != int(ancestor_id) and self.is_descendant_or_self(concept_id, ancestor_id)
+
+    def descendant_positions(self, concept_id, include_self=False):
+        i = self.index.position(concept_id)
+        if i is None:
+            return np.empty(0, dtype=np.int64)
+        starts, ends = self.intervals(i)
+        positions = np.concatenate([self.order[s:e + 1] for s, e in zip(starts, ends)])
+        if not include_self:
+            positions = positions[positions != i]
+        return np.sort(positions)
+
+    def ancestor_positions(self, concept_id, include_self=False):
+        i = self.index.position(concept_id)
+        if i is None:
+            return np.empty(0, dtype=np.int64)
+        seen = {i}
+        frontier = [i]
+        while frontier:
+            parents = np.concatenate([self.index.parent_positions(p) for p in frontier]).tolist()
+            frontier = [p for p in parents if p not in seen]
+            seen.update(frontier)
+        if not include_self:
+            seen.discard(i)
+        return np.array(sorted(seen), dtype=np.int64)
+
+    def descendants(self, concept_id, include_self=False):
+        return self.index.concept_ids[self.descendant_positions(concept_id, include_self)]
+
+    def ancestors(self, concept_id, include_self=False):
+        return self.index.concept_ids[self.ancestor_positions(concept_id, include_self)]
+
+
+def spanning_tree_labels(index):
+    """
+    Numbers the concepts in post-order over a spanning tree that keeps the first parent of every concept.
+    low[i] is the smallest post-order number in the subtree of i.
+    """
+    n = len(index)
+    has_parent = np.diff(index.parent_offsets) > 0
+    positions = np.arange(n)
+    tree_parents = index.parent_indices[index.parent_offsets[:-1][has_parent]]
+    tree_offsets, tree_children = build_csr(tree_parents, positions[has_parent], n)
+    tree_offsets = tree_offsets.tolist()
+    tree_children = tree_children.tolist()
+    next_child = tree_offsets[:-1]
+    post = [0] * n
+    low = [0] * n
+    counter = 0
+    for root in positions[~has_parent].tolist():
+        low[root] = counter
+        stack = [root]
+        while stack:
+            node = stack[-1]
+            c = next_child[node]
+            if c < tree_offsets[node + 1]:
+                next_child[node] = c + 1
+                child = tree_children[c]
+                low[child] = counter
+                stack.append(child)
+            else:
+                stack.pop()
+                post[node] = counter
+                counter += 1
+    return np.array(post, dtype=np.int64), low
+
+
+def merge_intervals(intervals):
+    intervals.sort()
+    merged = [intervals[0]]
+    for start, end in intervals[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            if end > last_end:
+                merged[-1] = (last_start, end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def build_closure(index):
+    """
+    Computes the interval labelling of every concept, visiting children before their parents.
+    """
+    n = len(index)
+    post, low = spanning_tree_labels(index)
+    child_offsets = index.child_offsets.tolist()
+    child_indices = index.child_indices.tolist()
+    parent_offsets = index.parent_offsets.tolist()
+    parent_indices = index.parent_indices.tolist()
+    remaining = np.diff(index.child_offsets).tolist()
+    post_list = post.tolist()
+    intervals = [None] * n
+    ready = [i for i in range(n) if remaining[i] == 0]
+    while ready:
+        node = ready.pop()
+        own = [(low[node], post_list[node])]
+        for c in child_indices[child_offsets[node]:child_offsets[node + 1]]:
+            own.extend(intervals[c])
+        intervals[node] = merge_intervals(own)
+        for p in parent_indices[parent_offsets[node]:parent_offsets[node + 1]]:
+            remaining[p] -= 1
+            if remaining[p] == 0:
+                ready.append(p)
+    counts = np.array([len(node_intervals) for node_intervals in intervals], dtype=np.int64)
+    interval_offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=interval_offsets[1:])
+    flat = np.array([interval for node_intervals in intervals for interval in node_intervals], dtype=np.int64).reshape(-1, 2)
+    order = np.argsort(post).astype(np.int32)
+    return SnomedClosure(index, post, order, interval_offsets, flat[:, 0].copy(), flat[:, 1].copy())
+
+
+def save_closure(closure, path=None):
+    np.savez(path or CLOSURE_PATH, concept_ids=closure.index.concept_ids, post=closure.post, order=closure.order,
+             interval_offsets=closure.interval_offsets, interval_starts=closure.interval_starts,
+             interval_ends=closure.interval_ends)
+
+
+def load_closure(index, path=None):
+    """
+    Loads a saved closure, returning None if it was built from a different set of concepts.
+    """
+    path = path or CLOSURE_PATH
+    if not path.exists():
+        return None
+    data = np.load(path)
+    if not np.array_equal(data['concept_ids'], index.concept_ids):
+        return None
+    return SnomedClosure(index, data['post'], data['order'], data['interval_offsets'],
+                         data['interval_starts'], data['interval_ends'])
+
+
+def get_closure():
+    """
+    Returns the process-wide closure for the local SNOMED index, loading it from disk or building and
+    saving it on first use. Returns None when there is no local index.
+    """
+    global _closure, _closure_loaded
+    if not _closure_loaded:
+        with _closure_lock:
+            if not _closure_loaded:
+                index = get_index()
+                if index is not None and index.snapshot_section('closure'):
+                    _closure = SnomedClosure(index, **index.snapshot_section('closure'))
+                elif index is not None:
+                    _closure = load_closure(index)
+                    if _closure is None:
+                        print("Building SNOMED transitive closure...")
+                        _closure = build_closure(index)
+                        save_closure(_closure)
+                _closure_loaded = True
+    return _closure
+
+
+def is_descendant_of(concept_id, ancestor_id, include_self=False):
+    closure = get_closure()
+    if closure is None:
+        return None
+    if include_self:
+        return closure.is_descendant_or_self(concept_id, ancestor_id)
+    return closure.is_descendant(concept_id, ancestor_id)
+
+
+def get_descendants(concept_id, include_self=False):
+    closure = get_closure()
+    return closure.descendants(concept_id, include_self) if closure is not None else None
+
+
+def get_ancestors(concept_id, include_self=False):
+    closure = get_closure()
+    return closure.ancestors(concept_id, include_self) if closure is not None else None
+
+
+def classify(concept_ids, value_sets):
+    """
+    Tests many concepts against many value sets at once. value_sets maps a name to the root concept of a
+    '<<' value set; the result maps each name to a boolean array aligned with concept_ids.
+    """
+    closure = get_closure()
+    if closure is None:
+        return None
+    index = closure.index
+    concept_ids = np.asarray(concept_ids, dtype=np.int64)
+    positions = np.searchsorted(index.concept_ids, concept_ids)
+    positions = np.minimum(positions, len(index) - 1)
+    known = index.concept_ids[positions] == concept_ids
+    results = {}
+    for name, root_id in value_sets.items():
+        root = index.position(root_id)
+        if root is None:
+            results[name] = np.zeros(len(concept_ids), dtype=bool)
+        else:
+            results[name] = closure.contains(root, positions) & known
+    return results
+
+
+def evaluate_constraint(search_string):
+    """
+    Answers single-concept hierarchy constraints ('<', '<<', '>', '>>', '<!', '>!') locally. Returns None
+    for anything else so the caller can fall back to Hermes.
+    """
+    result = evaluate_index_constraint(search_string)
+    if result is not None:
+        return result
+    constraint = normalize_constraint(search_string)
+    for operator in ('<<', '>>', '<', '>'):
+        if constraint.startswith(operator):
+            concept_id = constraint[len(operator):]
+            break
+    else:
+        return None
+    if not concept_id.isdigit():
+        return None
+    closure = get_closure()
+    if closure is None or closure.index.position(concept_id) is None:
+        return None
+    include_self = len(operator) == 2
+    if operator[0] == '<':
+        positions = closure.descendant_positions(concept_id, include_self)
+    else:
+        positions = closure.ancestor_positions(concept_id, include_self)
+    return closure.index.to_results(positions)
+
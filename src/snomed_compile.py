@@ -0,0 +1,30 @@
+from src.snomed_binary import write_snapshot
+from src.snomed_closure import CLOSURE_SECTIONS, build_closure
+from src.snomed_index import INDEX_SECTIONS, SNOMED_BINARY_PATH, SNOMED_RF2_DIR, find_snapshot_files, load_rf2_index
+from src.snomed_term_search import TERM_SECTIONS, build_term_index
+
+
+def compile_snapshot(rf2_dir=None, path=None):
+    """
+    Parses the RF2 snapshot once and writes the index, its closure, the term search index and the
+    preferred-term table into a single memory-mappable file that snomed_index.get_index() opens on later runs.
+    """
+    rf2_dir = rf2_dir or SNOMED_RF2_DIR
+    path = path or SNOMED_BINARY_PATH
+    index = load_rf2_index(rf2_dir)
+    if index is None:
+        print("No RF2 snapshot to compile.")
+        return None
+    closure = build_closure(index)
+    term_index = build_term_index(index, find_snapshot_files(rf2_dir)[1])
+    arrays = {name: getattr(index, name) for name in INDEX_SECTIONS}
+    arrays.update({f'closure.{name}': getattr(closure, name) for name in CLOSURE_SECTIONS})
+    arrays.update({f'term_search.{name}': getattr(term_index, name) for name in TERM_SECTIONS})
+    strings = {'terms': index.terms, 'vocabulary': term_index.vocabulary}
+    write_snapshot(path, arrays, strings, {'release': index.release})
+    print(f"Wrote SNOMED snapshot for release {index.release} to {path}")
+    return path
+
+
+if __name__ == '__main__':
+    compile_snapshot()
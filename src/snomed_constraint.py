@@ -1,5 +1,5 @@
 from pprint import pprint
-import requests
+from src.snomed_parent import search_constraint
 
 BASE_HERMES_URL = 'http://159.65.173.51:8080/v1/snomed'
 
@@ -78,8 +78,7 @@ def constraint_7():
 
 
 def expression_constraint(search_string):
-    response = requests.get(f'{BASE_HERMES_URL}/search?constraint={search_string}')
-    data = response.json()
+    data = search_constraint(search_string)
     pprint(data)
 
 
@@ -0,0 +1,232 @@
+import re
+import numpy as np
+from src.snomed_closure import get_closure
+from src.snomed_closure import evaluate_constraint as evaluate_hierarchy_constraint
+
+# Local evaluator for the subset of SNOMED ECL used in snomed_constraint.py: hierarchy operators, '*',
+# AND / OR / MINUS, nested expressions and attribute refinements with '=' / '!=' and {} attribute groups.
+# Expressions are parsed into a plan of nested tuples and executed as set operations over sorted
+# arrays of concept positions. Anything outside the subset raises ValueError so callers fall back to Hermes.
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(\|[^|]*\|)|(<<!|<<|<!|<|>>!|>>|>!|>|!=|=|:|,|\{|\}|\(|\)|\*)|(\d+)|([A-Za-z]+)|(\S))')
+CONSTRAINT_OPERATORS = ('<<!', '<<', '<!', '<', '>>!', '>>', '>!', '>')
+BINARY_OPERATORS = {'AND': 'and', 'OR': 'or', 'MINUS': 'minus', ',': 'and'}
+
+# Relationship (source, group) pairs are packed into one int64 so attribute groups can be intersected as arrays
+GROUP_FACTOR = 1 << 16
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if match is None:
+            break
+        position = match.end()
+        term, symbol, number, word, other = match.groups()
+        if term is not None:
+            continue
+        if other is not None:
+            raise ValueError(f"Unsupported ECL syntax near '{other}'")
+        if word is not None:
+            word = word.upper()
+            if word not in BINARY_OPERATORS:
+                raise ValueError(f"Unsupported ECL keyword '{word}'")
+            tokens.append(word)
+        else:
+            tokens.append(symbol or number)
+    return tokens
+
+
+def parse(expression):
+    """
+    Parses an ECL expression into a plan. Expression nodes are ('concept', operator, concept_id),
+    ('any', operator), ('nested', operator, plan), ('refine', focus, refinement) and (set_operator, left, right).
+    Refinement nodes are ('attribute', attribute, comparator, value), ('group', refinement) and
+    (set_operator, left, right).
+    """
+    tokens = tokenize(expression)
+    plan, position = parse_expression(tokens, 0)
+    if position != len(tokens):
+        raise ValueError(f"Unexpected ECL token '{tokens[position]}'")
+    return plan
+
+
+def peek(tokens, position):
+    return tokens[position] if position < len(tokens) else None
+
+
+def expect(tokens, position, token):
+    if peek(tokens, position) != token:
+        raise ValueError(f"Expected '{token}' in ECL expression")
+    return position + 1
+
+
+def parse_expression(tokens, position):
+    left, position = parse_sub_expression(tokens, position)
+    while peek(tokens, position) in BINARY_OPERATORS:
+        operator = BINARY_OPERATORS[tokens[position]]
+        right, position = parse_sub_expression(tokens, position + 1)
+        left = (operator, left, right)
+    return left, position
+
+
+def parse_sub_expression(tokens, position):
+    focus, position = parse_focus(tokens, position)
+    if peek(tokens, position) == ':':
+        refinement, position = parse_refinement(tokens, position + 1)
+        return ('refine', focus, refinement), position
+    return focus, position
+
+
+def parse_focus(tokens, position):
+    operator = None
+    if peek(tokens, position) in CONSTRAINT_OPERATORS:
+        operator = tokens[position]
+        position += 1
+    token = peek(tokens, position)
+    if token == '*':
+        return ('any', operator), position + 1
+    if token == '(':
+        plan, position = parse_expression(tokens, position + 1)
+        return ('nested', operator, plan), expect(tokens, position, ')')
+    if token is not None and token.isdigit():
+        return ('concept', operator, int(token)), position + 1
+    raise ValueError("Expected a concept, '*' or '(' in ECL expression")
+
+
+def parse_refinement(tokens, position):
+    left, position = parse_refinement_item(tokens, position)
+    while peek(tokens, position) in BINARY_OPERATORS and peek(tokens, position) != 'MINUS':
+        operator = BINARY_OPERATORS[tokens[position]]
+        right, position = parse_refinement_item(tokens, position + 1)
+        left = (operator, left, right)
+    return left, position
+
+
+def parse_refinement_item(tokens, position):
+    token = peek(tokens, position)
+    if token == '{':
+        refinement, position = parse_refinement(tokens, position + 1)
+        return ('group', refinement), expect(tokens, position, '}')
+    if token == '(':
+        refinement, position = parse_refinement(tokens, position + 1)
+        return refinement, expect(tokens, position, ')')
+    attribute, position = parse_focus(tokens, position)
+    comparator = peek(tokens, position)
+    if comparator not in ('=', '!='):
+        raise ValueError("Only '=' and '!=' attribute comparisons are supported")
+    value, position = parse_focus(tokens, position + 1)
+    return ('attribute', attribute, comparator, value), position
+
+
+def apply_operator(closure, operator, positions):
+    """
+    Expands a sorted array of concept positions through a hierarchy operator.
+    """
+    if operator is None:
+        return positions
+    index = closure.index
+    if operator in ('<!', '<<!', '>!', '>>!'):
+        neighbours = index.child_positions if operator[0] == '<' else index.parent_positions
+        parts = [neighbours(i) for i in positions.tolist()]
+    elif operator[0] == '<':
+        parts = [closure.descendant_positions(index.concept_ids[i], include_self=False) for i in positions.tolist()]
+    else:
+        parts = [closure.ancestor_positions(index.concept_ids[i], include_self=False) for i in positions.tolist()]
+    if operator in ('<<!', '<<', '>>!', '>>'):
+        parts.append(positions)
+    if not parts:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(parts).astype(np.int64))
+
+
+def combine(operator, left, right):
+    if operator == 'and':
+        return np.intersect1d(left, right, assume_unique=True)
+    if operator == 'or':
+        return np.union1d(left, right)
+    return np.setdiff1d(left, right, assume_unique=True)
+
+
+def execute(closure, plan):
+    """
+    Executes an expression plan and returns the sorted concept positions it matches.
+    """
+    kind = plan[0]
+    if kind == 'concept':
+        i = closure.index.position(plan[2])
+        if i is None:
+            raise ValueError(f"Concept {plan[2]} is not in the local SNOMED index")
+        return apply_operator(closure, plan[1], np.array([i], dtype=np.int64))
+    if kind == 'any':
+        everything = np.arange(len(closure.index), dtype=np.int64)
+        if plan[1] is None or plan[1] in ('<<', '>>', '<<!', '>>!'):
+            return everything
+        # Descendants (or children) of any concept are the concepts with a parent; ancestors (or parents)
+        # of any concept are the concepts with a child
+        if plan[1][0] == '<':
+            return everything[np.diff(closure.index.parent_offsets) > 0]
+        return everything[np.diff(closure.index.child_offsets) > 0]
+    if kind == 'nested':
+        return apply_operator(closure, plan[1], execute(closure, plan[2]))
+    if kind == 'refine':
+        focus = execute(closure, plan[1])
+        return np.intersect1d(focus, execute_refinement(closure, plan[2], grouped=False), assume_unique=True)
+    return combine(kind, execute(closure, plan[1]), execute(closure, plan[2]))
+
+
+def execute_refinement(closure, plan, grouped):
+    """
+    Executes a refinement plan. Inside an attribute group the result is packed (source, group) pairs so
+    that every attribute must match within the same group; outside it is plain source positions.
+    """
+    kind = plan[0]
+    if kind == 'attribute':
+        pairs = match_attribute(closure, plan[1], plan[2], plan[3])
+        return pairs if grouped else np.unique(pairs // GROUP_FACTOR)
+    if kind == 'group':
+        return np.unique(execute_refinement(closure, plan[1], grouped=True) // GROUP_FACTOR)
+    return combine(kind, execute_refinement(closure, plan[1], grouped), execute_refinement(closure, plan[2], grouped))
+
+
+def match_attribute(closure, attribute, comparator, value):
+    attribute_types = execute(closure, attribute)
+    values = execute(closure, value)
+    matches = []
+    for type_position in attribute_types.tolist():
+        sources, destinations, groups = closure.index.attribute_relationships(type_position)
+        mask = np.isin(destinations, values, assume_unique=False)
+        if comparator == '!=':
+            mask = ~mask
+        matches.append(sources[mask].astype(np.int64) * GROUP_FACTOR + groups[mask])
+    if not matches:
+        return np.empty(0, dtype=np.int64)
+    return np.unique(np.concatenate(matches))
+
+
+def evaluate_positions(search_string):
+    closure = get_closure()
+    if closure is None:
+        return None
+    return execute(closure, parse(search_string))
+
+
+def evaluate_constraint(search_string):
+    """
+    Evaluates an ECL constraint against the local SNOMED index and returns results in the same shape as a
+    Hermes search. Returns None when there is no local index or the expression is not supported locally.
+    """
+    result = evaluate_hierarchy_constraint(search_string)
+    if result is not None:
+        return result
+    try:
+        positions = evaluate_positions(search_string)
+    except ValueError as e:
+        print(f"Falling back to Hermes for ECL constraint: {e}")
+        return None
+    if positions is None:
+        return None
+    return get_closure().index.to_results(positions)
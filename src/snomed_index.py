@@ -0,0 +1,325 @@
+import csv
+import re
+import sys
+import threading
+import numpy as np
+from src.registration import data_dir
+from src.snomed_binary import open_snapshot
+from src.snomed_cache import normalize_constraint
+
+# Local SNOMED CT hierarchy and attribute relationships built once from an RF2 snapshot so lookups do not need Hermes.
+# Place the unzipped release (or just its Snapshot folder) under SNOMED_RF2_DIR, or compile it once into
+# SNOMED_BINARY_PATH with `python -m src.snomed_compile` so later runs map it instead of parsing RF2 text.
+SNOMED_RF2_DIR = data_dir / "snomed"
+SNOMED_BINARY_PATH = data_dir / "snomed.bin"
+INDEX_SECTIONS = (
+    'concept_ids', 'parent_offsets', 'parent_indices', 'child_offsets', 'child_indices',
+    'attribute_types', 'attribute_offsets', 'attribute_sources', 'attribute_destinations', 'attribute_groups',
+)
+IS_A = 116680003
+SYNONYM = 900000000000013009
+FULLY_SPECIFIED_NAME = 900000000000003001
+US_ENGLISH_REFSET = 900000000000509007
+PREFERRED = 900000000000548007
+
+_index = None
+_index_loaded = False
+_index_lock = threading.Lock()
+
+csv.field_size_limit(sys.maxsize)
+
+
+class SnomedIndex:
+    """
+    Array-backed is-a hierarchy. concept_ids is a sorted int64 array; the parents of the concept at
+    position i are parent_indices[parent_offsets[i]:parent_offsets[i + 1]] (positions, not IDs), and
+    children are stored the same way.
+    """
+
+    def __init__(self, concept_ids, parent_offsets, parent_indices, child_offsets, child_indices, terms,
+                 attribute_types=None, attribute_offsets=None, attribute_sources=None, attribute_destinations=None,
+                 attribute_groups=None):
+        self.concept_ids = concept_ids
+        self.parent_offsets = parent_offsets
+        self.parent_indices = parent_indices
+        self.child_offsets = child_offsets
+        self.child_indices = child_indices
+        self.terms = terms
+        # Non is-a relationships grouped by attribute type: the relationships of attribute_types[k] are
+        # attribute_sources/destinations/groups[attribute_offsets[k]:attribute_offsets[k + 1]], sorted by destination.
+        self.attribute_types = attribute_types if attribute_types is not None else np.empty(0, dtype=np.int32)
+        self.attribute_offsets = attribute_offsets if attribute_offsets is not None else np.zeros(1, dtype=np.int64)
+        self.attribute_sources = attribute_sources if attribute_sources is not None else np.empty(0, dtype=np.int32)
+        self.attribute_destinations = attribute_destinations if attribute_destinations is not None else np.empty(0, dtype=np.int32)
+        self.attribute_groups = attribute_groups if attribute_groups is not None else np.empty(0, dtype=np.int32)
+        self.release = None
+        # Extra sections (closure, term search) when the index was opened from a compiled snapshot
+        self.snapshot_arrays = {}
+        self.snapshot_strings = {}
+
+    def __len__(self):
+        return len(self.concept_ids)
+
+    def position(self, concept_id):
+        concept_id = int(concept_id)
+        i = int(np.searchsorted(self.concept_ids, concept_id))
+        if i < len(self.concept_ids) and self.concept_ids[i] == concept_id:
+            return i
+        return None
+
+    def parent_positions(self, i):
+        return self.parent_indices[self.parent_offsets[i]:self.parent_offsets[i + 1]]
+
+    def child_positions(self, i):
+        return self.child_indices[self.child_offsets[i]:self.child_offsets[i + 1]]
+
+    def parents(self, concept_id):
+        i = self.position(concept_id)
+        if i is None:
+            return np.empty(0, dtype=np.int64)
+        return self.concept_ids[self.parent_positions(i)]
+
+    def children(self, concept_id):
+        i = self.position(concept_id)
+        if i is None:
+            return np.empty(0, dtype=np.int64)
+        return self.concept_ids[self.child_positions(i)]
+
+    def attribute_relationships(self, type_position):
+        """
+        Returns the (sources, destinations, groups) position arrays of one attribute type.
+        """
+        k = int(np.searchsorted(self.attribute_types, type_position))
+        if k == len(self.attribute_types) or self.attribute_types[k] != type_position:
+            start = end = 0
+        else:
+            start, end = self.attribute_offsets[k], self.attribute_offsets[k + 1]
+        return self.attribute_sources[start:end], self.attribute_destinations[start:end], self.attribute_groups[start:end]
+
+    def snapshot_section(self, prefix):
+        """
+        Returns the compiled snapshot arrays whose names start with 'prefix.', keyed without the prefix.
+        """
+        arrays = {
+            name[len(prefix) + 1:]: array for name, array in self.snapshot_arrays.items()
+            if name.startswith(f'{prefix}.')
+        }
+        return arrays or None
+
+    def preferred_term(self, concept_id):
+        i = self.position(concept_id)
+        return self.terms[i] if i is not None else None
+
+    def to_results(self, positions):
+        """
+        Formats concept positions the way Hermes returns search results.
+        """
+        return [
+            {
+                'conceptId': int(self.concept_ids[i]),
+                'term': self.terms[i],
+                'preferredTerm': self.terms[i],
+            }
+            for i in positions
+        ]
+
+
+def build_csr(row_positions, column_positions, size):
+    order = np.lexsort((column_positions, row_positions))
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_positions, minlength=size), out=offsets[1:])
+    return offsets, column_positions[order].astype(np.int32)
+
+
+def read_rf2(path):
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        header = next(reader)
+        columns = {name: i for i, name in enumerate(header)}
+        for row in reader:
+            yield columns, row
+
+
+def read_relationships(relationship_path):
+    """
+    Splits the active relationships into is-a (source, destination) pairs and attribute
+    (source, type, destination, group) rows.
+    """
+    sources = []
+    destinations = []
+    attributes = []
+    for columns, row in read_rf2(relationship_path):
+        if row[columns['active']] != '1':
+            continue
+        type_id = int(row[columns['typeId']])
+        if type_id == IS_A:
+            sources.append(int(row[columns['sourceId']]))
+            destinations.append(int(row[columns['destinationId']]))
+        else:
+            attributes.append((int(row[columns['sourceId']]), type_id, int(row[columns['destinationId']]),
+                               int(row[columns['relationshipGroup']])))
+    attributes = np.array(attributes, dtype=np.int64).reshape(-1, 4)
+    return np.array(sources, dtype=np.int64), np.array(destinations, dtype=np.int64), attributes
+
+
+def read_preferred_description_ids(language_path):
+    preferred = set()
+    for columns, row in read_rf2(language_path):
+        if (row[columns['active']] == '1'
+                and int(row[columns['refsetId']]) == US_ENGLISH_REFSET
+                and int(row[columns['acceptabilityId']]) == PREFERRED):
+            preferred.add(int(row[columns['referencedComponentId']]))
+    return preferred
+
+
+def read_preferred_terms(description_path, concept_ids, language_path=None):
+    """
+    Returns the preferred synonym of every concept. Without a language refset the fully specified name
+    is used with its semantic tag removed.
+    """
+    preferred_ids = read_preferred_description_ids(language_path) if language_path else None
+    terms = [None] * len(concept_ids)
+    fallback = [None] * len(concept_ids)
+    for columns, row in read_rf2(description_path):
+        if row[columns['active']] != '1':
+            continue
+        concept_id = int(row[columns['conceptId']])
+        i = int(np.searchsorted(concept_ids, concept_id))
+        if i >= len(concept_ids) or concept_ids[i] != concept_id:
+            continue
+        type_id = int(row[columns['typeId']])
+        term = row[columns['term']]
+        if type_id == FULLY_SPECIFIED_NAME:
+            fallback[i] = term.rsplit(' (', 1)[0] if term.endswith(')') else term
+        elif type_id == SYNONYM and preferred_ids is not None and int(row[columns['id']]) in preferred_ids:
+            terms[i] = term
+    return [term if term is not None else (fallback[i] or '') for i, term in enumerate(terms)]
+
+
+def build_attribute_index(attributes, concept_ids):
+    sources = np.searchsorted(concept_ids, attributes[:, 0])
+    types = np.searchsorted(concept_ids, attributes[:, 1])
+    destinations = np.searchsorted(concept_ids, attributes[:, 2])
+    order = np.lexsort((destinations, types))
+    types = types[order]
+    attribute_types, counts = np.unique(types, return_counts=True)
+    attribute_offsets = np.zeros(len(attribute_types) + 1, dtype=np.int64)
+    np.cumsum(counts, out=attribute_offsets[1:])
+    return (attribute_types.astype(np.int32), attribute_offsets, sources[order].astype(np.int32),
+            destinations[order].astype(np.int32), attributes[order, 3].astype(np.int32))
+
+
+def build_index(relationship_path, description_path, language_path=None):
+    """
+    Loads RF2 relationship and description snapshot files into a SnomedIndex.
+    """
+    sources, destinations, attributes = read_relationships(relationship_path)
+    concept_ids = np.unique(np.concatenate([sources, destinations, attributes[:, :3].ravel()]))
+    source_positions = np.searchsorted(concept_ids, sources)
+    destination_positions = np.searchsorted(concept_ids, destinations)
+    parent_offsets, parent_indices = build_csr(source_positions, destination_positions, len(concept_ids))
+    child_offsets, child_indices = build_csr(destination_positions, source_positions, len(concept_ids))
+    terms = read_preferred_terms(description_path, concept_ids, language_path)
+    return SnomedIndex(concept_ids, parent_offsets, parent_indices, child_offsets, child_indices, terms,
+                       *build_attribute_index(attributes, concept_ids))
+
+
+def find_snapshot_files(rf2_dir):
+    """
+    Finds the inferred relationship, English description and language refset snapshot files in an RF2 folder.
+    """
+    relationships = [
+        path for path in rf2_dir.rglob('sct2_Relationship_Snapshot*.txt')
+        if 'Concrete' not in path.name
+    ]
+    descriptions = list(rf2_dir.rglob('sct2_Description_Snapshot-en*.txt'))
+    languages = list(rf2_dir.rglob('der2_cRefset_LanguageSnapshot-en*.txt'))
+    if not relationships or not descriptions:
+        return None
+    return relationships[0], descriptions[0], languages[0] if languages else None
+
+
+def get_release(relationship_path):
+    match = re.search(r'_(\d{8})\.txt$', relationship_path.name)
+    return match.group(1) if match else None
+
+
+def load_rf2_index(rf2_dir=None):
+    rf2_dir = rf2_dir or SNOMED_RF2_DIR
+    if not rf2_dir.exists():
+        return None
+    files = find_snapshot_files(rf2_dir)
+    if files is None:
+        print(f"No RF2 snapshot found in {rf2_dir}")
+        return None
+    print(f"Loading SNOMED hierarchy from {files[0].name}")
+    index = build_index(*files)
+    index.release = get_release(files[0])
+    return index
+
+
+def open_binary_index(path=None):
+    """
+    Maps a compiled snapshot file. The arrays and term table are views of the mapping, not copies.
+    """
+    arrays, strings, metadata = open_snapshot(path or SNOMED_BINARY_PATH)
+    index = SnomedIndex(*(arrays[name] for name in INDEX_SECTIONS[:5]), strings['terms'],
+                        *(arrays[name] for name in INDEX_SECTIONS[5:]))
+    index.release = metadata.get('release')
+    index.snapshot_arrays = {name: array for name, array in arrays.items() if name not in INDEX_SECTIONS}
+    index.snapshot_strings = {name: table for name, table in strings.items() if name != 'terms'}
+    return index
+
+
+def load_index():
+    if SNOMED_BINARY_PATH.exists():
+        try:
+            return open_binary_index()
+        except ValueError as e:
+            print(f"Ignoring SNOMED snapshot file: {e}")
+    return load_rf2_index()
+
+
+def get_index():
+    """
+    Returns the process-wide SNOMED index, loading it on first use. Returns None when neither a compiled
+    snapshot nor an RF2 snapshot is available so callers can fall back to Hermes.
+    """
+    global _index, _index_loaded
+    if not _index_loaded:
+        with _index_lock:
+            if not _index_loaded:
+                _index = load_index()
+                _index_loaded = True
+    return _index
+
+
+def set_index(index):
+    global _index, _index_loaded
+    with _index_lock:
+        _index = index
+        _index_loaded = True
+
+
+def evaluate_constraint(search_string, index=None):
+    """
+    Answers '>! id' (parents) and '<! id' (children) constraints from the local index in the same shape
+    as a Hermes search. Returns None when there is no index or the constraint is not one of these forms.
+    """
+    index = index or get_index()
+    if index is None:
+        return None
+    constraint = normalize_constraint(search_string)
+    if constraint.startswith('>!'):
+        positions = index.parent_positions
+    elif constraint.startswith('<!'):
+        positions = index.child_positions
+    else:
+        return None
+    concept_id = constraint[2:]
+    if not concept_id.isdigit():
+        return None
+    i = index.position(concept_id)
+    if i is None:
+        return None
+    return index.to_results(positions(i))
@@ -1,9 +1,24 @@
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 from wsgiref.util import request_uri
 
 import requests
+from src import http_client, snomed_cache
+from src.snomed_cache import get_cached, set_cached
+from src.snomed_ecl import evaluate_constraint
+from src.snomed_index import get_index
 
 BASE_HERMES_URL = 'http://159.65.173.51:8080/v1/snomed'
+# Lists the installed SNOMED releases (edition and extensions) with their YYYYMMDD versions
+HERMES_STATUS_URL = f'{BASE_HERMES_URL}/status'
+RELEASE_DATE_PATTERN = re.compile(r'\b((?:19|20)\d{2}(?:0[1-9]|1[0-2])(?:0[1-9]|[12]\d|3[01]))\b')
+# Upper bound on concurrent Hermes lookups when resolving many concepts at once
+MAX_WORKERS = 8
+
+_release_configured = False
+_release_lock = threading.Lock()
 
 
 def constraint_parent(concept_id):
@@ -23,20 +38,68 @@ def constraint_child(concept_id):
     return constraint
 
 
-def expression_constraint(search_string):
+def get_hermes_release():
     """
-    Perform a search using the SNOMED ECL constraint and print the concept ID and preferred term.
+    Returns the release Hermes serves as its YYYYMMDD version(s), e.g. '20240301+20240401' for an edition
+    with an extension, or None if Hermes does not report it.
+    """
+    try:
+        response = http_client.get(HERMES_STATUS_URL, headers={"Accept": "application/json"})
+        if response.status_code != 200:
+            print(f"Hermes did not report its release. HTTP Status {response.status_code}")
+            return None
+        versions = sorted(set(RELEASE_DATE_PATTERN.findall(response.text)))
+        return '+'.join(versions) or None
+    except requests.RequestException as e:
+        print(f"Error: Network error occurred - {e}")
+        return None
+
+
+def configure_cache_release():
+    """
+    Tags the SNOMED cache with the release Hermes serves, or that of the local snapshot when Hermes does not
+    report one, so ECL results cached from an earlier release stop being used after an upgrade. Runs once
+    per process, before the first cache lookup; a release set with snomed_cache.configure is kept.
+    """
+    global _release_configured
+    if _release_configured:
+        return
+    with _release_lock:
+        if _release_configured:
+            return
+        if snomed_cache.SNOMED_RELEASE == "default":
+            release = get_hermes_release()
+            if release is None:
+                index = get_index()
+                release = index.release if index is not None else None
+            if release is None:
+                print("SNOMED release unknown; cached ECL results only expire after the cache TTL")
+            else:
+                print(f"SNOMED cache tagged with release {release}")
+                snomed_cache.configure(release=release)
+        _release_configured = True
+
+
+def search_constraint(search_string):
+    """
+    Return the full Hermes result list for an ECL constraint. Constraints are evaluated against the
+    local RF2 index when one is loaded; anything else is served from the SNOMED cache or Hermes.
     """
+    local_result = evaluate_constraint(search_string)
+    if local_result is not None:
+        return local_result
+    configure_cache_release()
+    cached = get_cached(search_string)
+    if cached is not None:
+        return cached
     try:
         # Make the request
-        response = requests.get(f'{BASE_HERMES_URL}/search?constraint={search_string.strip()}')
+        response = http_client.get(f'{BASE_HERMES_URL}/search?constraint={search_string.strip()}')
         # Handle the response
         if response.status_code == 200:
             data = response.json()
-            if len(data) > 0:
-                concept_id = data[0]['conceptId']
-                concept_preferred_term = data[0]['preferredTerm']
-                return concept_id, concept_preferred_term
+            set_cached(search_string, data)
+            return data
         else:
             print(f"Error: HTTP Status {response.status_code}")
             pprint(response.json())
@@ -44,19 +107,75 @@ def expression_constraint(search_string):
         print(f"Error: Network error occurred - {e}")
 
 
+def expression_constraint(search_string):
+    """
+    Perform a search using the SNOMED ECL constraint and print the concept ID and preferred term.
+    """
+    data = search_constraint(search_string)
+    if data:
+        concept_id = data[0]['conceptId']
+        concept_preferred_term = data[0]['preferredTerm']
+        return concept_id, concept_preferred_term
+
+
+def resolve_locally(concept_ids, relation='parent'):
+    """
+    Resolves codes straight from the local SNOMED index, without building or parsing ECL. Returns the
+    resolved dict (as in resolve_concepts) and the codes the index does not know, or has no index for.
+    """
+    index = get_index()
+    if index is None:
+        return {}, list(concept_ids)
+    positions = index.parent_positions if relation == 'parent' else index.child_positions
+    resolved = {}
+    missing = []
+    for concept_id in concept_ids:
+        i = index.position(concept_id) if concept_id.isdigit() else None
+        if i is None:
+            missing.append(concept_id)
+            continue
+        results = index.to_results(positions(i)[:1])
+        resolved[concept_id] = (results[0]['conceptId'], results[0]['preferredTerm']) if results else None
+    return resolved, missing
+
+
+def resolve_concepts(concept_ids, relation='parent', max_workers=MAX_WORKERS):
+    """
+    Resolve the parent or child of many SNOMED codes at once. Codes are de-duplicated and answered from the
+    local index when one is loaded; the rest are looked up (through the ECL cache, then Hermes) with bounded
+    concurrency. The result maps each distinct code to (concept_id, term), or None if not found.
+    """
+    build_constraint = constraint_parent if relation == 'parent' else constraint_child
+    distinct_ids = list(dict.fromkeys(str(concept_id).strip() for concept_id in concept_ids if concept_id))
+    if not distinct_ids:
+        return {}
+    resolved, missing = resolve_locally(distinct_ids, relation)
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(missing))) as executor:
+            results = executor.map(lambda concept_id: expression_constraint(build_constraint(concept_id)), missing)
+            resolved.update(zip(missing, results))
+    return {concept_id: resolved[concept_id] for concept_id in distinct_ids}
+
+
+def resolve_parents_and_children(concept_ids, max_workers=MAX_WORKERS):
+    """
+    Resolve both directions for a cohort's codes. Returns (parents, children) dicts as in resolve_concepts.
+    """
+    concept_ids = list(concept_ids)
+    return (resolve_concepts(concept_ids, 'parent', max_workers),
+            resolve_concepts(concept_ids, 'child', max_workers))
+
+
 if __name__ == '__main__':
     # Specify the SNOMED concept ID
     snomed_concept_id = "74400008"
     ascendant_constraint = constraint_parent(snomed_concept_id)
     print(f"Searching for ascendants of concept ID: {snomed_concept_id}")
-    parent_concept_id = expression_constraint(search_string=ascendant_constraint)[0]
-    parent_concept_term = expression_constraint(search_string=ascendant_constraint)[1]
+    parent_concept_id, parent_concept_term = expression_constraint(search_string=ascendant_constraint)
     print(f'Parent:{parent_concept_id}')
     print(f'Parent term: {parent_concept_term}')
 
     child_constraint = constraint_child(concept_id=snomed_concept_id)
-    child_terms = expression_constraint(search_string=child_constraint)
-    child_concept_id = expression_constraint(search_string=child_constraint)[0]
-    child_concept_term = expression_constraint(search_string=child_constraint)[1]
+    child_concept_id, child_concept_term = expression_constraint(search_string=child_constraint)
     print(f'Child:{child_concept_id}')
     print(f'Child term: {child_concept_term}')
@@ -1,5 +1,6 @@
 
 import requests
+from src import http_client
 
 # Base URL for the Hermes SNOMED CT API
 BASE_HERMES_URL = 'http://159.65.173.51:8080/v1/snomed/concepts'
@@ -11,7 +12,7 @@ def get_extended(concept_id):
     """
     try:
         url = f'{BASE_HERMES_URL}/{concept_id}'
-        response = requests.get(url)
+        response = http_client.get(url)
         print(response.url)  # Debugging: Print the request URL
 
         if response.status_code == 200:
@@ -37,7 +38,7 @@ def get_parent_terms_using_ecl(concept_id):
         # ECL query to search for parent terms of the concept
         ecl_query = f"^ {concept_id} | Concept ID (concept) | "  # ECL query for parents
         url = f'{BASE_HERMES_URL}/search?constraint={ecl_query}'
-        response = requests.get(url)
+        response = http_client.get(url)
         print(response.url)  # Debugging: Print the request URL
 
         if response.status_code == 200:
@@ -0,0 +1,178 @@
+import re
+import threading
+from bisect import bisect_left
+import numpy as np
+import requests
+from src import http_client
+from src.snomed_index import SNOMED_RF2_DIR, find_snapshot_files, get_index, read_rf2
+from src.snomed_parent import BASE_HERMES_URL
+
+# Local full-text search over SNOMED descriptions. Every active description is tokenized into lowercase
+# words; the sorted vocabulary maps each word to a posting list of description numbers, so a query word
+# matches every vocabulary entry it is a prefix of. Concepts are ranked by their best matching description,
+# with the preferred term boosted and shorter descriptions (better coverage of the query) ranked higher.
+TERM_SECTIONS = ('posting_offsets', 'postings', 'description_concepts', 'description_preferred', 'description_lengths')
+PREFERRED_BOOST = 1.0
+WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+_term_index = None
+_term_index_loaded = False
+_term_index_lock = threading.Lock()
+
+
+def tokenize(text):
+    return WORD_PATTERN.findall(text.lower())
+
+
+class TermIndex:
+    def __init__(self, index, vocabulary, posting_offsets, postings, description_concepts, description_preferred,
+                 description_lengths):
+        self.index = index
+        self.vocabulary = vocabulary
+        self.posting_offsets = posting_offsets
+        self.postings = postings
+        self.description_concepts = description_concepts
+        self.description_preferred = description_preferred
+        self.description_lengths = description_lengths
+
+    def matching_descriptions(self, word):
+        """
+        Returns the sorted description numbers containing a word that starts with the given prefix.
+        """
+        low = bisect_left(self.vocabulary, word)
+        high = bisect_left(self.vocabulary, word + '\uffff', lo=low)
+        if high - low == 1:
+            return self.postings[self.posting_offsets[low]:self.posting_offsets[high]]
+        parts = [self.postings[self.posting_offsets[k]:self.posting_offsets[k + 1]] for k in range(low, high)]
+        if not parts:
+            return np.empty(0, dtype=np.int32)
+        return np.unique(np.concatenate(parts))
+
+    def search(self, term, max_hits=10):
+        """
+        Returns up to max_hits (conceptId, preferredTerm) tuples for concepts having a description that
+        contains every word of the term as a word prefix.
+        """
+        words = sorted(set(tokenize(term)))
+        if not words:
+            return []
+        matches = sorted((self.matching_descriptions(word) for word in words), key=len)
+        descriptions = matches[0]
+        for match in matches[1:]:
+            if len(descriptions) == 0:
+                break
+            descriptions = np.intersect1d(descriptions, match, assume_unique=True)
+        if len(descriptions) == 0:
+            return []
+        concepts = self.description_concepts[descriptions]
+        scores = (PREFERRED_BOOST * self.description_preferred[descriptions]
+                  + len(words) / np.maximum(self.description_lengths[descriptions], 1))
+        # Keep the best scoring description of each concept, then rank concepts by that score
+        order = np.lexsort((-scores, concepts))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = concepts[order][1:] != concepts[order][:-1]
+        best = order[first]
+        best = best[np.argsort(-scores[best], kind='stable')][:max_hits]
+        return [
+            (int(self.index.concept_ids[position]), self.index.terms[position])
+            for position in concepts[best].tolist()
+        ]
+
+
+def build_term_index(index, description_path):
+    """
+    Builds the inverted index over the active descriptions of the concepts in the SNOMED index.
+    """
+    word_numbers = {}
+    postings = []
+    description_concepts = []
+    description_preferred = []
+    description_lengths = []
+    for columns, row in read_rf2(description_path):
+        if row[columns['active']] != '1':
+            continue
+        position = index.position(row[columns['conceptId']])
+        if position is None:
+            continue
+        term = row[columns['term']]
+        words = set(tokenize(term))
+        number = len(description_concepts)
+        description_concepts.append(position)
+        description_preferred.append(term == index.terms[position])
+        description_lengths.append(len(words))
+        for word in words:
+            if word not in word_numbers:
+                word_numbers[word] = len(postings)
+                postings.append([])
+            postings[word_numbers[word]].append(number)
+    vocabulary = sorted(word_numbers)
+    posting_lists = [postings[word_numbers[word]] for word in vocabulary]
+    posting_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+    np.cumsum([len(posting_list) for posting_list in posting_lists], out=posting_offsets[1:])
+    flat_postings = np.fromiter((n for posting_list in posting_lists for n in posting_list), dtype=np.int32,
+                                count=int(posting_offsets[-1]))
+    return TermIndex(index, vocabulary, posting_offsets, flat_postings,
+                     np.array(description_concepts, dtype=np.int32),
+                     np.array(description_preferred, dtype=np.bool_),
+                     np.array(description_lengths, dtype=np.int16))
+
+
+def get_term_index():
+    """
+    Returns the process-wide term index, taken from the compiled snapshot or built from the RF2 description
+    file on first use. Returns None when there is no local SNOMED data.
+    """
+    global _term_index, _term_index_loaded
+    if not _term_index_loaded:
+        with _term_index_lock:
+            if not _term_index_loaded:
+                index = get_index()
+                sections = index.snapshot_section('term_search') if index is not None else None
+                if sections and 'vocabulary' in index.snapshot_strings:
+                    _term_index = TermIndex(index, index.snapshot_strings['vocabulary'], **sections)
+                elif index is not None and SNOMED_RF2_DIR.exists():
+                    files = find_snapshot_files(SNOMED_RF2_DIR)
+                    if files is not None:
+                        print("Building SNOMED term index...")
+                        _term_index = build_term_index(index, files[1])
+                _term_index_loaded = True
+    return _term_index
+
+
+def search_hermes(term, max_hits=10):
+    try:
+        response = http_client.get(f'{BASE_HERMES_URL}/search', params={'s': term, 'maxHits': max_hits})
+        if response.status_code == 200:
+            return [(item['conceptId'], item['preferredTerm']) for item in response.json()]
+        print(f"Error: HTTP Status {response.status_code}")
+    except requests.RequestException as e:
+        print(f"Error: Network error occurred - {e}")
+    return []
+
+
+def search_term(term, max_hits=10):
+    """
+    Searches SNOMED descriptions for free text, locally when possible and through Hermes otherwise.
+    Returns (conceptId, preferredTerm) tuples like snomed_parent.expression_constraint.
+    """
+    term_index = get_term_index()
+    if term_index is None:
+        return search_hermes(term, max_hits)
+    return term_index.search(term, max_hits)
+
+
+def search_terms(terms, max_hits=1):
+    """
+    Batch version of search_term for many problem-list strings. Each distinct string is searched once and
+    the result maps every input string to its list of (conceptId, preferredTerm) tuples.
+    """
+    by_words = {}
+    results = {}
+    for term in terms:
+        if term in results:
+            continue
+        words = ' '.join(sorted(set(tokenize(term))))
+        if words not in by_words:
+            by_words[words] = search_term(term, max_hits)
+        results[term] = by_words[words]
+    return results
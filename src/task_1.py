@@ -1,55 +1,33 @@
 #imported required packages
-import json
-from datetime import datetime
 from pprint import pprint
-import requests
-from pathlib import Path
-from src.data_templates import patient_template_dict, condition_template_dict
+from src import etl_state, fhir_loader, id_mapping, token_provider
+from src.data_templates import ConditionFields, PatientFields, build_condition, build_patient
 from src.snomed_parent import constraint_parent, expression_constraint
-from src.registration import data_dir
-import random
 #BASE URL for OpenEMR and Primary care website
 BASE_URL = "https://in-info-web20.luddy.indianapolis.iu.edu/apis/default/fhir"
 BASE_PRIMARY_CARE_URL = "http://137.184.71.65:8080/fhir"
+# verificationStatus is optional in FHIR R4; a Condition without one is loaded as unconfirmed
+DEFAULT_VERIFICATION_STATUS = "unconfirmed"
 
-#Retrieves the access token from a local JSON file. Returns the token if found, otherwise returns None.
-def get_access_token_from_file():
-    file_path = Path(data_dir / "access_token.json")
-    if not file_path.exists():
-        print("Error: access_token.json file not found.")
-        return None
-    try:
-        with open(file_path, 'r') as json_file:
-            json_data = json.load(json_file)
-            access_token = json_data.get("access_token")
-        return access_token
-    except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error reading access token from file: {e}")
-        return None
-
-def get_headers(): #Constructs headers for API requests, including the authorization token.
-    access_token = get_access_token_from_file()
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    return headers
-
-#Reads the patient resource ID from a local text file. Returns the resource ID if the file exists, otherwise returns None.
-def get_patient_resource_id():
-    file_path = data_dir / "patient_resource_id.txt"
-    try:
-        with open(file_path, 'r') as file:
-            resource_id = file.read().strip()
-            return resource_id
-    except FileNotFoundError:
-        print(f"Error: {file_path} not found.")
-        return None
-
-#Fetches patient details from the FHIR server using the resource ID. Updates the patient template dictionary with fetched data and sends it to the Primary Care FHIR server to create or update the patient resource.
+#Returns the Primary Care resource ID of a patient loaded from OpenEMR, looked up in the ID mapping by its OpenEMR ID. Without an OpenEMR ID the most recently loaded patient is returned. Returns None if no such patient was loaded.
+def get_patient_resource_id(openemr_patient_id=None):
+    if openemr_patient_id is None:
+        resource_id = id_mapping.get_latest_target_id('Patient')
+    else:
+        resource_id = id_mapping.get_target_id('Patient', openemr_patient_id)
+    if resource_id is None:
+        print(f"Error: no Primary Care patient mapped for {openemr_patient_id or 'any OpenEMR patient'}.")
+    return resource_id
+
+#Fetches patient details from the FHIR server using the resource ID and loads them into the Primary Care FHIR server.
 def get_fhir_patient(resource_id):
     url = f'{BASE_URL}/Patient/{resource_id}'
-    response = requests.get(url=url, headers=get_headers())
-    data = response.json()
+    response = token_provider.get(url=url)
+    post_patient(response.json())
+
+
+#Builds a new Primary Care Patient resource from an OpenEMR Patient resource.
+def transform_patient(data):
     birth_date = data.get('birthDate')
     family_name = data['name'][0]['family']
     given_name = data['name'][0]['given'][0]
@@ -62,38 +40,36 @@ def get_fhir_patient(resource_id):
     state = address.get('state', '')
     postal_code = address.get('postalCode', '')
     text = f'{line}, {city}, {state}, {postal_code}'
-    unique_patient_id = random.randint(10000, 99999)
-    today_date = datetime.today().date().isoformat()
+    unique_patient_id = fhir_loader.source_identifier_value('Patient', data['id'])
+    # Taken from the source record rather than the run date, so loading an unchanged patient again is a no-op
+    identifier_start = (data.get('identifier') or [{}])[0].get('period', {}).get('start')
     gender = data.get('gender')
 
-    # Populate the patient template
-    patient_template_dict["birthDate"] = birth_date
-    patient_template_dict['name'][0]['family'] = family_name
-    patient_template_dict['name'][0]['given'][0] = given_name
-    patient_template_dict['address'][0]['line'][0] = line
-    patient_template_dict['address'][0]['city'] = city
-    patient_template_dict['address'][0]['district'] = district
-    patient_template_dict['address'][0]['state'] = state
-    patient_template_dict['address'][0]['postalCode'] = postal_code
-    patient_template_dict['identifier'][0]['period']['start'] = today_date
-    patient_template_dict['identifier'][0]['value'] = unique_patient_id
-    patient_template_dict['gender'] = gender
-    patient_template_dict['address'][0]['text'] = text
-    try: # Sends the updated patient data to the Primary Care EHR server
-        headers = {
-            "Accept": 'application/json'
-        }
-        url = BASE_PRIMARY_CARE_URL + '/' + 'Patient'
-        response = requests.post(url=url, json=patient_template_dict, headers=headers)
-        if response.status_code == 200 or response.status_code == 201:
-            response_data = response.json()
-            new_patient_resource_id = response_data['id']
-            with open(data_dir / 'patient_resource_id.txt', 'w') as f: # Saves the new resource ID to a file
-                f.write(new_patient_resource_id)
-        else:
-            print('Error')
-    except Exception as e:
-        print(e)
+    return build_patient(PatientFields(
+        identifier_value=unique_patient_id,
+        identifier_start=identifier_start,
+        family=family_name,
+        given=given_name,
+        gender=gender,
+        birth_date=birth_date,
+        line=line,
+        city=city,
+        district=district,
+        state=state,
+        postal_code=postal_code,
+        text=text,
+    ))
+
+
+#Sends an OpenEMR Patient resource to the Primary Care FHIR server to create or update the patient resource. Returns True on success.
+def post_patient(data):
+    patient = transform_patient(data)
+    # Conditional update on the identifier, so loading the same OpenEMR patient again updates it in place
+    new_patient_resource_id = fhir_loader.conditional_update(patient)
+    if new_patient_resource_id is None:
+        return False
+    id_mapping.set_target_id('Patient', data['id'], new_patient_resource_id) # Maps the OpenEMR ID to the new resource ID
+    return True
 
 
 def search_condition(patient_resource_id):
@@ -101,46 +77,101 @@ def search_condition(patient_resource_id):
     Create a condition resource on Primary Care EHR FHIR Server
     :return:
     """
-    # Searches for conditions related to a specific patient resource ID on the FHIR server. Updates the condition template dictionary with hierarchical SNOMED data and sends it to the Primary Care FHIR server.
+    # Searches for conditions related to a specific patient resource ID on the FHIR server. Builds a condition with hierarchical SNOMED data and sends it to the Primary Care FHIR server.
     url = f'{BASE_URL}/Condition?patient={patient_resource_id}'
-    response = requests.get(url=url, headers=get_headers())
+    response = token_provider.get(url=url)
     data = response.json()
     if 'entry' in data:
         conditions = data['entry']
         first_condition = conditions[0]
         pprint(first_condition)
-        snomed_code_from_openemr = first_condition["resource"]["code"]["coding"][0]["code"]
+        post_condition(first_condition["resource"])
+
+
+#Returns the SNOMED code of an OpenEMR Condition, or None if it has no coded code.
+def get_condition_code(condition):
+    coding = condition.get('code', {}).get('coding') or [{}]
+    return coding[0].get('code')
+
+
+#Returns the verification status code of an OpenEMR Condition, DEFAULT_VERIFICATION_STATUS if it has none.
+def get_verification_status(condition):
+    coding = condition.get('verificationStatus', {}).get('coding') or [{}]
+    return coding[0].get('code') or DEFAULT_VERIFICATION_STATUS
+
+
+#Builds a new Primary Care Condition resource with the condition code replaced by its SNOMED parent. subject_reference is the Primary Care patient reference; parent_concept is the (conceptId, term) of the parent when it was already resolved. Raises ValueError if the condition has no code or the code has no parent.
+def transform_condition(condition, subject_reference, parent_concept=None):
+    if parent_concept is None:
+        snomed_code_from_openemr = get_condition_code(condition)
+        if snomed_code_from_openemr is None:
+            raise ValueError(f"Condition/{condition['id']} has no code")
         ascendant_constraint = constraint_parent(concept_id=snomed_code_from_openemr)
-        parent_concept_id = expression_constraint(search_string=ascendant_constraint)[0]
-        parent_concept_term = expression_constraint(search_string=ascendant_constraint)[1]
-
-        condition_template_dict["code"]["text"] = parent_concept_term
-        condition_template_dict["code"]["coding"][0]["display"] = parent_concept_term
-        condition_template_dict["code"]["coding"][0]["code"] = parent_concept_id
-        condition_template_dict['verificationStatus']['coding'][0]['code'] = first_condition['resource']['verificationStatus']['coding'][0]['code']
-        condition_template_dict["severity"]["coding"][0]["system"] = "http://snomed.info/sct"
-        condition_template_dict["severity"]["coding"][0]["code"] = "N/A"
-        condition_template_dict["severity"]["coding"][0]["display"] = "Not Applicable"
-        condition_template_dict["bodySite"][0]["coding"][0]["system"] = "http://snomed.info/sct"
-        condition_template_dict["bodySite"][0]["coding"][0]["code"] = "N/A"
-        condition_template_dict["bodySite"][0]["coding"][0]["display"] = "Not Applicable"
-        condition_template_dict["bodySite"][0]["text"] = "Not Applicable"
-        condition_template_dict["onsetDateTime"] = datetime.today().date().isoformat()
-        primary_care_resource_id = get_patient_resource_id()
-        condition_template_dict['subject']['reference'] = f"Patient/{primary_care_resource_id}"
-
-        try: # Send the condition data to the Primary Care FHIR server
-            headers = {
-                "Accept": 'application/json'
-            }
-            url = BASE_PRIMARY_CARE_URL + '/' + 'Condition'
-            response = requests.post(url=url, json=condition_template_dict, headers=headers)
-            if response.status_code == 200 or response.status_code == 201:
-                response_data = response.json()
-                print(response_data)
-
-        except Exception as e:
-            print(e)
+        parent_concept = expression_constraint(search_string=ascendant_constraint)
+        if parent_concept is None:
+            raise ValueError(f"No SNOMED parent found for {snomed_code_from_openemr}")
+    parent_concept_id, parent_concept_term = parent_concept
+
+    return build_condition(ConditionFields(
+        identifier_value=fhir_loader.source_identifier_value('Condition', condition['id'], 'parent'),
+        code=str(parent_concept_id),
+        term=parent_concept_term,
+        verification_status=get_verification_status(condition),
+        subject_reference=subject_reference,
+        onset=condition.get('onsetDateTime'),
+    ))
+
+
+#Sends an OpenEMR Condition, generalized to its SNOMED parent, to the Primary Care FHIR server. Returns True on success.
+def post_condition(condition):
+    subject_reference = id_mapping.get_reference(condition['subject']['reference'])
+    if subject_reference is None:
+        print(f"Error: {condition['subject']['reference']} has not been loaded into Primary Care.")
+        return False
+    try:
+        condition_resource = transform_condition(condition, subject_reference)
+    except ValueError as e:
+        print(f"Error: {e}")
+        return False
+
+    # Send the condition data to the Primary Care FHIR server
+    condition_resource_id = fhir_loader.conditional_update(condition_resource)
+    if condition_resource_id is None:
+        return False
+    print(f"Condition/{condition_resource_id} loaded into Primary Care.")
+    return True
+
+
+#Incremental sync: only patients and conditions changed in OpenEMR since the last successful run are loaded.
+def sync_patients():
+    return etl_state.run_incremental('Patient', post_patient)
+
+
+def sync_conditions():
+    return etl_state.run_incremental('Condition', post_condition)
+
+
+#Loads many OpenEMR patients and their conditions in transaction Bundles instead of one request per resource. A condition can reference a patient queued in the same Bundle. Returns (loaded, failed) counts.
+def load_patients_and_conditions(patients, conditions, bundle_size=fhir_loader.DEFAULT_BUNDLE_SIZE):
+    with fhir_loader.BundleLoader('transaction', bundle_size) as loader:
+        for patient in patients:
+            loader.add(transform_patient(patient), source_reference=f"Patient/{patient['id']}")
+        for condition in conditions:
+            subject_reference = loader.resolve_reference(condition['subject']['reference'])
+            if subject_reference is None:
+                print(f"Error: {condition['subject']['reference']} has not been loaded into Primary Care.")
+                loader.failed += 1
+                continue
+            try:
+                condition_resource = transform_condition(condition, subject_reference)
+            except ValueError as e:
+                print(f"Error: {e}")
+                loader.failed += 1
+                continue
+            loader.add(condition_resource, source_reference=f"Condition/{condition['id']}")
+    return loader.loaded, loader.failed
+
+
 # Main program execution
 if __name__ == '__main__':
     get_fhir_patient(resource_id='985ac7e3-d777-4393-be8d-db0dc7277ba8')
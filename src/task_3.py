@@ -1,5 +1,6 @@
 #Imported required packages
 import requests
+from src import adaptive_loader, fhir_loader, http_client
 import json
 from pathlib import Path
 from src.task_1 import get_patient_resource_id
@@ -22,8 +23,9 @@ def create_observation_data(patient_resource_id): #Function to generate the obse
             "status": "generated"
         },
         "identifier": [{
-            "system": "urn:ietf:rfc:3986",
-            "value": "urn:uuid:187e0c12-8dd2-67e2-99b2-bf273c878281"
+            "system": fhir_loader.URI_IDENTIFIER_SYSTEM,
+            # One blood pressure panel per patient and effective date
+            "value": fhir_loader.derived_identifier_value("Patient", patient_resource_id, "Observation", "85354-9", "2012-09-17")
         }],
         "basedOn": [{
             "identifier": {
@@ -125,20 +127,42 @@ def create_observation_data(patient_resource_id): #Function to generate the obse
     }
 
 
-def post_data_to_server(observation_data): # Function to post observation data to the API server
+def post_data_to_server(observation_data, max_retries=None): # Function to post observation data to the API server
     headers = {
         "Content-Type": "application/json",
+        # Conditional create: a rerun for the same patient finds the resource created the first time
+        "If-None-Exist": fhir_loader.identifier_search(observation_data['identifier'][0]),
     }
     try:
-        response = requests.post(BASE_PRIMARY_CARE_URL, json=observation_data, headers=headers)
+        response = http_client.post(BASE_PRIMARY_CARE_URL, json=observation_data, headers=headers, max_retries=max_retries)
         if response.status_code in [200, 201]:
             print("Observation posted successfully!")
             print("Response:", response.json())
         else:
             print(f"Failed to post observation. Status code: {response.status_code}")
             print("Error:", response.text)
+        return response
     except requests.exceptions.RequestException as e:
         print("Error during request:", e)
+        return None
+
+
+# Function to post the observation of many patients in batch Bundles, one request per bundle_size resources
+def post_data_in_bundles(patient_resource_ids, bundle_size=fhir_loader.DEFAULT_BUNDLE_SIZE):
+    observations = ((create_observation_data(patient_resource_id), None) for patient_resource_id in patient_resource_ids)
+    loaded, failed = fhir_loader.load_bundles(observations, bundle_type='batch', bundle_size=bundle_size, conditional='create')
+    print(f"{loaded} observation(s) posted, {failed} failed")
+    return loaded, failed
+
+
+# Function to post the observation of many patients one by one, with as many requests in flight as the server keeps up with
+def post_data_concurrently(patient_resource_ids, max_concurrency=adaptive_loader.MAX_LIMIT):
+    observations = (create_observation_data(patient_resource_id) for patient_resource_id in patient_resource_ids)
+    # No retries in the HTTP layer: a 429/503 has to reach the loader, which backs off and resends it
+    return adaptive_loader.load_adaptively(
+        observations, lambda observation_data: post_data_to_server(observation_data, max_retries=0),
+        max_limit=max_concurrency
+    )
 
 
 # Main execution
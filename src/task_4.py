@@ -1,5 +1,6 @@
 #Imported required packages
 import requests
+from src import adaptive_loader, fhir_loader, http_client
 import json
 from pathlib import Path
 from src.task_1 import get_patient_resource_id
@@ -13,6 +14,11 @@ data_dir.mkdir(exist_ok=True)
 def create_procedure_data(patient_resource_id):
     return {
         "resourceType": "Procedure",
+        "identifier": [{
+            "system": fhir_loader.URI_IDENTIFIER_SYSTEM,
+            # One appendectomy per patient
+            "value": fhir_loader.derived_identifier_value("Patient", patient_resource_id, "Procedure", "74400008")
+        }],
 
         "meta": {
             "versionId": "1",
@@ -53,21 +59,43 @@ def create_procedure_data(patient_resource_id):
     }
 
 # Function to POST JSON data to an API
-def post_data_to_server(procedure_data):
+def post_data_to_server(procedure_data, max_retries=None):
     headers = {
         "Content-Type": "application/json",
+        # Conditional create: a rerun for the same patient finds the resource created the first time
+        "If-None-Exist": fhir_loader.identifier_search(procedure_data['identifier'][0]),
     }
     try:
         # Sends the POST request with procedure data
-        response = requests.post(BASE_PRIMARY_CARE_URL, json=procedure_data, headers=headers)
+        response = http_client.post(BASE_PRIMARY_CARE_URL, json=procedure_data, headers=headers, max_retries=max_retries)
         if response.status_code in [200, 201]:
             print("Procedure posted successfully!")
             print("Response:", response.json())
         else:
             print(f"Failed to post procedure. Status code: {response.status_code}")
             print("Error:", response.text)
+        return response
     except requests.exceptions.RequestException as e:
         print("Error during request:", e)
+        return None
+
+# Function to post the procedure of many patients in batch Bundles, one request per bundle_size resources
+def post_data_in_bundles(patient_resource_ids, bundle_size=fhir_loader.DEFAULT_BUNDLE_SIZE):
+    procedures = ((create_procedure_data(patient_resource_id), None) for patient_resource_id in patient_resource_ids)
+    loaded, failed = fhir_loader.load_bundles(procedures, bundle_type='batch', bundle_size=bundle_size, conditional='create')
+    print(f"{loaded} procedure(s) posted, {failed} failed")
+    return loaded, failed
+
+
+# Function to post the procedure of many patients one by one, with as many requests in flight as the server keeps up with
+def post_data_concurrently(patient_resource_ids, max_concurrency=adaptive_loader.MAX_LIMIT):
+    procedures = (create_procedure_data(patient_resource_id) for patient_resource_id in patient_resource_ids)
+    # No retries in the HTTP layer: a 429/503 has to reach the loader, which backs off and resends it
+    return adaptive_loader.load_adaptively(
+        procedures, lambda procedure_data: post_data_to_server(procedure_data, max_retries=0),
+        max_limit=max_concurrency
+    )
+
 
 # Main execution
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+import json
+import threading
+import time
+from pathlib import Path
+from src import http_client
+from src.refresh_token import renew_access_token
+from src.registration import data_dir
+
+# Renew the access token this many seconds before it expires
+REFRESH_MARGIN = 60
+
+_token = None
+_token_lock = threading.Lock()
+
+
+def get_access_token_from_file():
+    """
+    Reads the token response saved by access_token.py / refresh_token.py. The file modification
+    time is used as the issue time because the response only carries a relative expires_in.
+    """
+    file_path = Path(data_dir / "access_token.json")
+    if not file_path.exists():
+        print("Error: access_token.json file not found.")
+        return None
+    try:
+        with open(file_path, 'r') as json_file:
+            json_data = json.load(json_file)
+        return build_token(json_data, issued_at=file_path.stat().st_mtime)
+    except (json.JSONDecodeError, KeyError) as e:
+        print(f"Error reading access token from file: {e}")
+        return None
+
+
+def build_token(token_data, issued_at):
+    expires_in = token_data.get('expires_in')
+    return {
+        'access_token': token_data.get('access_token'),
+        'expires_at': issued_at + int(expires_in) if expires_in else None,
+    }
+
+
+def is_expiring(token):
+    if token['expires_at'] is None:
+        return False
+    return time.time() >= token['expires_at'] - REFRESH_MARGIN
+
+
+def refresh_access_token(stale_token=None):
+    """
+    Renews the access token through refresh_token.renew_access_token. Only one thread refreshes at
+    a time; a caller that was waiting on the lock reuses the token another thread already renewed.
+    """
+    global _token
+    with _token_lock:
+        if _token is not None and _token['access_token'] != stale_token and not is_expiring(_token):
+            return _token['access_token']
+        token_data = renew_access_token()
+        if token_data:
+            _token = build_token(token_data, issued_at=time.time())
+        return _token['access_token'] if _token else None
+
+
+def get_access_token():
+    """
+    Returns the cached access token, loading it from disk on first use and refreshing it ahead of expiry.
+    """
+    global _token
+    token = _token
+    if token is None:
+        with _token_lock:
+            if _token is None:
+                _token = get_access_token_from_file()
+            token = _token
+        if token is None:
+            return None
+    if is_expiring(token):
+        return refresh_access_token(stale_token=token['access_token'])
+    return token['access_token']
+
+
+def get_headers():
+    access_token = get_access_token()
+    if not access_token:
+        return None
+    return {
+        "Authorization": f"Bearer {access_token}"
+    }
+
+
+def request(method, url, headers=None, **kwargs):
+    """
+    Sends an authorized request to OpenEMR. On a 401 the token is refreshed once and the request replayed.
+    """
+    access_token = get_access_token()
+    response = http_client.request(method, url, headers={**(headers or {}), "Authorization": f"Bearer {access_token}"}, **kwargs)
+    if response.status_code == 401:
+        response.close()
+        access_token = refresh_access_token(stale_token=access_token)
+        response = http_client.request(method, url, headers={**(headers or {}), "Authorization": f"Bearer {access_token}"}, **kwargs)
+    return response
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def clear_token():
+    global _token
+    with _token_lock:
+        _token = None
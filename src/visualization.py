@@ -1,80 +1,53 @@
-import json
-import requests
+from src import token_provider
+from src.fhir_search import (DEFAULT_PAGE_SIZE, DEFAULT_WORKERS, IncompleteSearchError, get_total, iter_pages,
+                              iter_pages_parallel, run_concurrently)
 from pprint import pprint
 import matplotlib.pyplot as plt
-from pathlib import Path
-from datetime import datetime
-from src.registration import data_dir
+import numpy as np
+from datetime import date, datetime
 
 # Correct API Base URL
 BASE_URL = "https://in-info-web20.luddy.indianapolis.iu.edu/apis/default/fhir"
+# Only these Patient elements are downloaded for the age plot
+AGE_ELEMENTS = ('birthDate',)
+# Bin edges of the age histogram; as in plt.hist the last bin includes its upper edge
+AGE_BINS = range(0, 100, 5)
+GENDERS = ('male', 'female', 'other', 'unknown')
 
-def get_access_token_from_file():
+def iter_patient_pages(count=DEFAULT_PAGE_SIZE, max_workers=None, elements=None):
     """
-    Reads the access token from a file.
+    Yields Patient search Bundles page by page, prefetching the next page while the current one is processed.
+    With max_workers the pages are fetched concurrently and yielded in arrival order. elements limits
+    the download to the given Patient elements. Raises IncompleteSearchError when pages are missing.
     """
-    file_path = Path(data_dir / "access_token.json")
-    if not file_path.exists():
-        print("Error: access_token.json file not found.")
-        return None
-    try:
-        with open(file_path, 'r') as json_file:
-            json_data = json.load(json_file)
-            access_token = json_data.get("access_token")
-        return access_token
-    except (json.JSONDecodeError, KeyError) as e:
-        print(f"Error reading access token from file: {e}")
-        return None
+    if not token_provider.get_access_token():
+        print("Access token is missing. Ensure access_token.json is properly set up.")
+        return
+    if max_workers:
+        yield from iter_pages_parallel('Patient', count=count, max_workers=max_workers, ordered=False,
+                                       elements=elements)
+    else:
+        yield from iter_pages('Patient', count=count, elements=elements, strict=True)
 
-def get_headers():
+def iter_patients(count=DEFAULT_PAGE_SIZE, max_workers=None, elements=None):
     """
-    Constructs the headers for API requests using the access token.
+    Yields Patient resources one by one; see iter_patient_pages.
     """
-    access_token = get_access_token_from_file()
-    if not access_token:
-        print("Access token is missing. Ensure access_token.json is properly set up.")
-        return None
-    headers = {
-        "Authorization": f"Bearer {access_token}"
-    }
-    return headers
+    for bundle in iter_patient_pages(count, max_workers, elements):
+        for entry in bundle.get('entry', []):
+            yield entry['resource']
 
 def get_all_patients():
     """
     Fetches all patients from the FHIR server, handling pagination if needed.
+    Holds every bundle entry in memory; prefer iter_patients() for large servers.
     """
-    url = f'{BASE_URL}/Patient'
-    patients = []
-    headers = get_headers()
-    if not headers:
-        print("Failed to construct headers. Exiting...")
+    if not token_provider.get_access_token():
+        print("Access token is missing. Ensure access_token.json is properly set up.")
         return []
-
-    while url:
-        try:
-            # Increase timeout to 180 seconds
-            response = requests.get(url=url, headers=headers, timeout=180)
-            print(f"Requesting URL: {url}")
-            print(f"Response Status Code: {response.status_code}")
-            if response.status_code == 200:
-                data = response.json()
-                if 'entry' in data:
-                    patients.extend(data['entry'])
-                # Check for pagination and get the next URL
-                url = data.get('link', [{}])[-1].get('url') if data.get('link') else None
-            else:
-                print(f"Failed to retrieve patients. Status code: {response.status_code}")
-                print(f"Response Text: {response.text}")
-                break
-        except requests.exceptions.Timeout:
-            print("Request timed out. Please check the server or your network connection.")
-            break
-        except requests.exceptions.RequestException as e:
-            print(f"An error occurred: {e}")
-            break
-        except json.JSONDecodeError:
-            print(f"Error decoding JSON from the response. Response text: {response.text}")
-            break
+    patients = []
+    for bundle in iter_pages('Patient'):
+        patients.extend(bundle.get('entry', []))
     return patients
 
 def calculate_age(birth_date):
@@ -86,32 +59,158 @@ def calculate_age(birth_date):
     age = today.year - birth_date.year - ((today.month, today.day) < (birth_date.month, birth_date.day))
     return age
 
-def plot_patient_ages():
+def parse_birth_dates(birth_dates):
     """
-    Plots a histogram of patient ages.
+    Converts birthDate strings to a datetime64[D] array in one step. Partial dates ('1990', '1990-05') fall on
+    the first day of the period; strings that are not dates are dropped.
     """
-    patients = get_all_patients()
-    if not patients:
-        print("No patients retrieved from the server. Exiting...")
-        return
+    try:
+        return np.array(birth_dates, dtype='datetime64[D]')
+    except ValueError:
+        parsed = []
+        for birth_date in birth_dates:
+            try:
+                parsed.append(np.datetime64(birth_date, 'D'))
+            except ValueError:
+                print(f"Skipping invalid birthDate: {birth_date}")
+        return np.array(parsed, dtype='datetime64[D]')
 
-    ages = []
-    for patient in patients:
-        birth_date = patient['resource'].get('birthDate')
-        if birth_date:
-            age = calculate_age(birth_date)
-            ages.append(age)
+def calculate_ages(birth_dates, today=None):
+    """
+    Vectorized calculate_age: returns the ages in whole years for a datetime64[D] array of birth dates.
+    """
+    today = today or date.today()
+    years = birth_dates.astype('datetime64[Y]').astype(np.int64) + 1970
+    months = birth_dates.astype('datetime64[M]')
+    month_numbers = months.astype(np.int64) % 12 + 1
+    days = (birth_dates - months).astype(np.int64) + 1
+    before_birthday = (month_numbers > today.month) | ((month_numbers == today.month) & (days > today.day))
+    return today.year - years - before_birthday
+
+class AgeHistogram:
+    """
+    Fixed-bin age histogram filled one page at a time; memory is O(bins) whatever the number of patients.
+    As in plt.hist the last bin includes its upper edge.
+    """
+
+    def __init__(self, bins=AGE_BINS, today=None):
+        self.edges = np.asarray(list(bins))
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.today = today or date.today()
+
+    def add_birth_dates(self, birth_dates):
+        if birth_dates:
+            ages = calculate_ages(parse_birth_dates(birth_dates), self.today)
+            self.counts += np.histogram(ages, bins=self.edges)[0]
 
-    if not ages:
+    def total(self):
+        return int(self.counts.sum())
+
+def get_age_histogram(bins=AGE_BINS, max_workers=None):
+    """
+    Streams the birthDate of every patient into an AgeHistogram, one page at a time. Pages are read
+    sequentially unless max_workers asks for the concurrent _offset fan-out.
+    """
+    histogram = AgeHistogram(bins)
+    for bundle in iter_patient_pages(max_workers=max_workers, elements=AGE_ELEMENTS):
+        histogram.add_birth_dates([
+            entry['resource']['birthDate'] for entry in bundle.get('entry', []) if entry['resource'].get('birthDate')
+        ])
+    return histogram
+
+def plot_patient_ages(max_workers=None):
+    """
+    Plots a histogram of patient ages.
+    """
+    try:
+        histogram = get_age_histogram(AGE_BINS, max_workers)
+    except IncompleteSearchError as e:
+        print(f"Not plotting a partial age distribution: {e}")
+        return
+    if not histogram.total():
         print("No patient ages found to plot.")
         return
 
     # Plotting the age distribution
     plt.figure(figsize=(10, 6))
-    plt.hist(ages, bins=range(0, 100, 5), edgecolor='black', alpha=0.7)
+    plt.hist(histogram.edges[:-1], bins=histogram.edges, weights=histogram.counts, edgecolor='black', alpha=0.7)
+    plt.title("Age Distribution of Patients")
+    plt.xlabel("Age (years)")
+    plt.ylabel("Frequency")
+    plt.grid(axis='y', linestyle='--', alpha=0.7)
+    plt.show()
+
+def years_before(day, years):
+    try:
+        return day.replace(year=day.year - years)
+    except ValueError:  # 29 February
+        return day.replace(year=day.year - years, day=28)
+
+def age_range_params(low, high, today, inclusive=False):
+    """
+    Returns birthdate search parameters matching low <= age < high (age <= high when inclusive) on today.
+    """
+    upper_age = high + 1 if inclusive else high
+    return {'birthdate': [f'le{years_before(today, low).isoformat()}',
+                          f'gt{years_before(today, upper_age).isoformat()}']}
+
+def count_patients(params_list, max_workers=DEFAULT_WORKERS):
+    """
+    Runs one _summary=count Patient search per parameter set concurrently and returns the totals in order.
+    """
+    tasks = (lambda params=params: get_total('Patient', params) for params in params_list)
+    return list(run_concurrently(tasks, max_workers))
+
+def count_age_buckets(bins=AGE_BINS, search_param=None, values=None, max_workers=DEFAULT_WORKERS):
+    """
+    Counts patients per age bucket on the server, one _summary=count query per bucket, without downloading
+    any Patient. With search_param and values (e.g. 'gender', GENDERS or 'address-state', ['IN', 'OH'])
+    every bucket is also split by value. Returns a dict of value (None without a breakdown) to the list of
+    bucket counts, or None if the server does not report totals.
+    """
+    edges = list(bins)
+    today = date.today()
+    buckets = [
+        age_range_params(low, high, today, inclusive=number == len(edges) - 2)
+        for number, (low, high) in enumerate(zip(edges, edges[1:]))
+    ]
+    values = list(values) if search_param else [None]
+    params_list = [
+        {**bucket, search_param: value} if search_param else bucket
+        for value in values for bucket in buckets
+    ]
+    totals = count_patients(params_list, max_workers)
+    if any(total is None for total in totals):
+        print("The server did not report a total for every bucket.")
+        return None
+    return {value: totals[number * len(buckets):(number + 1) * len(buckets)] for number, value in enumerate(values)}
+
+def count_by(search_param, values, params=None, max_workers=DEFAULT_WORKERS):
+    """
+    Counts patients per value of a search parameter, e.g. count_by('gender', GENDERS). Returns a dict of
+    value to count (None where the server did not report one).
+    """
+    totals = count_patients([{**(params or {}), search_param: value} for value in values], max_workers)
+    return dict(zip(values, totals))
+
+def plot_patient_age_counts(search_param=None, values=None, max_workers=DEFAULT_WORKERS):
+    """
+    Plots the age histogram from server-side counts, stacked by value when a breakdown is given. Falls back
+    to plot_patient_ages when the server does not support _summary=count.
+    """
+    counts = count_age_buckets(AGE_BINS, search_param, values, max_workers)
+    if counts is None:
+        plot_patient_ages()
+        return
+    edges = list(AGE_BINS)
+    plt.figure(figsize=(10, 6))
+    plt.hist([edges[:-1]] * len(counts), bins=edges, weights=list(counts.values()), stacked=True,
+             label=[str(value) for value in counts], edgecolor='black', alpha=0.7)
     plt.title("Age Distribution of Patients")
     plt.xlabel("Age (years)")
     plt.ylabel("Frequency")
+    if search_param:
+        plt.legend(title=search_param)
     plt.grid(axis='y', linestyle='--', alpha=0.7)
     plt.show()
 